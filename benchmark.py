@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from preprocess import split_texts
+from postprocess import get_unique_terms_context
+from find_duplicates import CUTOFFS
+from find_duplicates import get_internal_tf_idf_matrix
+from find_duplicates import get_internal_similarities
+from find_duplicates import compute_cosine_similarity_in_chunks
+from find_duplicates import get_best_master_matches
+from find_duplicates import find_internal_duplicates
+from find_duplicates import find_duplicates_vs_master
+from find_duplicates import highlight_all_terms
+from find_duplicates import make_vectorizer
+
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# scripts whose start-up, mostly imports, is measured in a fresh process
+COLD_START_MODULES = ['preprocess', 'postprocess', 'find_duplicates', 'only_find_duplicates']
+SYLLABLES = [
+    'ka', 'lo', 'mi', 'ne', 'ra', 'to', 'su', 'vi', 'pe', 'do',
+    'ga', 'li', 'mo', 'ri', 'ta', 'bu', 'ce', 'fa', 'ho', 'ju',
+    'an', 'er', 'in', 'on', 'ul', 'ax', 'ey', 'os', 'ti', 'que'
+    ]
+FILLER = ['the', 'of', 'and', 'for', 'with', 'is', 'in', 'to', 'under', 'each', 'all', 'by']
+BULLETS = ['', '', '- ', '• ', '1. ', '* ']
+
+
+def make_words(rng, n_words):
+    """Return n_words distinct pseudo-words of two to four syllables."""
+    words = set()
+    while len(words) < n_words:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_variant(rng, term):
+    """Return a near duplicate of term, as found in real glossaries."""
+    kind = rng.randrange(6)
+    if kind == 0:
+        return term.upper()
+    if kind == 1:
+        return term.title()
+    if kind == 2:
+        return term.replace(' ', '-', 1) if ' ' in term else term + '-based'
+    if kind == 3:
+        return term + 's'
+    if kind == 4 and len(term) > 3:
+        pos = rng.randrange(len(term) - 1)
+        return term[:pos] + term[pos + 1] + term[pos] + term[pos + 2:]  # swapped letters
+    return f'"{term}"'
+
+
+def make_terms(rng, n_terms, variant_share=0.2):
+    """Return n_terms distinct terms of one to four words, variant_share of them near duplicates."""
+    words = make_words(rng, max(50, int(n_terms ** 0.5) * 4))
+    terms = []
+    seen = set()
+    while len(terms) < n_terms:
+        if terms and rng.random() < variant_share:
+            term = make_variant(rng, rng.choice(terms))
+        else:
+            term = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        if term not in seen:
+            seen.add(term)
+            terms.append(term)
+    return terms
+
+
+def make_master_lines(rng, terms, n_master, overlap_share=0.1):
+    """Return master list lines 'Term|definition', overlap_share of them variants of terms."""
+    lines = []
+    for term in make_terms(rng, n_master):
+        if rng.random() < overlap_share:
+            term = make_variant(rng, rng.choice(terms))
+        lines.append(f'{term}|{rng.choice(FILLER)} {term.lower()} definition')
+    return lines
+
+
+def make_sentence(rng, term):
+    words = [rng.choice(FILLER) for _ in range(rng.randint(4, 12))]
+    words.insert(rng.randrange(len(words) + 1), term)
+    return ' '.join(words).capitalize() + '.'
+
+
+def make_segments(rng, terms, n_segments, terms_per_segment=10):
+    """Return (requests, responses, filenames) as sent to and returned by the LLM.
+
+    Each response lists the segment's terms with bullets and changed case,
+    plus a few terms the LLM made up that are not in the segment.
+    """
+    requests, responses, filenames = [], [], []
+    for segment_idx in range(n_segments):
+        segment_terms = [rng.choice(terms) for _ in range(terms_per_segment)]
+        requests.append(' '.join(make_sentence(rng, term) for term in segment_terms))
+        listed = segment_terms + [rng.choice(terms) for _ in range(2)]
+        responses.append('\n'.join(
+            rng.choice(BULLETS) + (term.upper() if rng.random() < 0.1 else term)
+            for term in listed
+            ))
+        filenames.append(f'doc_{segment_idx // 20}.txt')
+    return requests, responses, filenames
+
+
+def make_source_lines(rng, terms, n_lines):
+    return [make_sentence(rng, rng.choice(terms)) for _ in range(n_lines)]
+
+
+def make_best_matches(rng, n_terms, n_candidates, match_share=0.3):
+    """Return random (best ids, best scores) shaped like get_best_*_matches results."""
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    has_match = np_rng.random(n_terms) < match_share
+    best_ids = np.where(has_match, np_rng.integers(0, max(n_candidates, 1), n_terms), -1)
+    best_scores = np.where(has_match, np_rng.uniform(0.8, 1.0, n_terms), 0.0)
+    return best_ids, best_scores
+
+
+# Each setup function builds the inputs of one stage for `size` terms
+# (lines for split_texts) and returns the call to measure.
+
+def setup_split_texts(rng, size):
+    lines = make_source_lines(rng, make_terms(rng, min(size, 10_000)), size)
+    return lambda: split_texts(lines, 250)
+
+
+def setup_get_unique_terms_context(rng, size):
+    requests, responses, filenames = make_segments(rng, make_terms(rng, size), max(size // 10, 1))
+    return lambda: get_unique_terms_context(requests, responses, filenames)
+
+
+def setup_get_internal_similarities(rng, size):
+    tf_idf_matrix = get_internal_tf_idf_matrix([term.lower() for term in make_terms(rng, size)])
+    return lambda: get_internal_similarities(tf_idf_matrix)
+
+
+def get_master_matrices(rng, size):
+    terms = make_terms(rng, size)
+    master_terms = [line.split('|')[0].strip().lower() for line in make_master_lines(rng, terms, size)]
+    vectorizer = make_vectorizer()
+    old_tf_idf_matrix = vectorizer.fit_transform(master_terms)
+    return vectorizer.transform([term.lower() for term in terms]), old_tf_idf_matrix
+
+
+def setup_compute_cosine_similarity_in_chunks(rng, size):
+    tf_idf_matrix, old_tf_idf_matrix = get_master_matrices(rng, size)
+    return lambda: compute_cosine_similarity_in_chunks(tf_idf_matrix, old_tf_idf_matrix)
+
+
+def setup_get_best_master_matches(rng, size):
+    tf_idf_matrix, old_tf_idf_matrix = get_master_matrices(rng, size)
+    return lambda: get_best_master_matches(tf_idf_matrix, old_tf_idf_matrix)
+
+
+def setup_find_duplicates_vs_master(rng, size):
+    internal_records = find_internal_duplicates(make_best_matches(rng, size, size), cutoff_sim=2)
+    best_master_matches = make_best_matches(rng, size, size)
+    return lambda: [
+        find_duplicates_vs_master(internal_records, best_master_matches, cutoff_sim)
+        for cutoff_sim in CUTOFFS
+        ]
+
+
+def setup_highlight_all_terms(rng, size):
+    terms = make_terms(rng, size)
+    terms_contexts_uniq = {
+        term: {'contexts': [make_sentence(rng, term) for _ in range(5)], 'filename': 'doc.txt'}
+        for term in terms
+        }
+    records = find_internal_duplicates(make_best_matches(rng, size, size), cutoff_sim=2)
+    return lambda: highlight_all_terms(records, terms, terms_contexts_uniq, num_contexts=5)
+
+
+# stage -> (setup, largest size run unless --no_limits);
+# the limits skip sizes needing dense tables or hours of scoring
+STAGES = {
+    'split_texts': (setup_split_texts, None),
+    'get_unique_terms_context': (setup_get_unique_terms_context, None),
+    'get_internal_similarities': (setup_get_internal_similarities, 100_000),
+    'compute_cosine_similarity_in_chunks': (setup_compute_cosine_similarity_in_chunks, 10_000),
+    'get_best_master_matches': (setup_get_best_master_matches, 100_000),
+    'find_duplicates_vs_master': (setup_find_duplicates_vs_master, None),
+    'highlight_all_terms': (setup_highlight_all_terms, 100_000),
+    }
+
+
+def measure(run, trace_memory=True):
+    """Return wall time of run() and, in a second traced call, its peak Python/numpy allocations."""
+    start = time.perf_counter()
+    run()
+    wall_time = time.perf_counter() - start
+
+    peak_memory = None
+    if trace_memory:
+        # tracing slows pure Python code down, so it is kept out of the timed call
+        tracemalloc.start()
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return wall_time, peak_memory
+
+
+def run_benchmarks(stages, sizes, seed=0, trace_memory=True, no_limits=False):
+    results = []
+    for stage in stages:
+        setup, max_size = STAGES[stage]
+        for size in sizes:
+            result = {'stage': stage, 'size': size}
+            if max_size is not None and size > max_size and not no_limits:
+                result['skipped'] = f'size above {max_size} for this stage, see --no_limits'
+            else:
+                # each run gets its own generator, so any subset of runs is reproducible
+                run = setup(random.Random(f'{seed}-{stage}-{size}'), size)
+                result['wall_time'], result['peak_memory'] = measure(run, trace_memory)
+            print(json.dumps(result))
+            results.append(result)
+    return results
+
+
+def time_process(args, cwd, repeats=3):
+    """Return the best wall time of running args in a new process."""
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        wall_times.append(time.perf_counter() - start)
+    return min(wall_times)
+
+
+def run_cold_start_benchmarks(seed=0, n_terms=10, n_master=1_000):
+    """Time a bare import of each script, then a whole only_find_duplicates run
+    checking n_terms terms against n_master master terms, as a user starts it."""
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in COLD_START_MODULES:
+        result = {'stage': f'cold_start_{module}', 'size': 0}
+        result['wall_time'] = time_process([sys.executable, '-c', f'import {module}'], code_dir)
+        print(json.dumps(result))
+        results.append(result)
+
+    rng = random.Random(f'{seed}-cold_start')
+    terms = make_terms(rng, n_terms)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        new_terms_filename = os.path.join(tmp_dir, 'new_terms.txt')
+        master_terms_filename = os.path.join(tmp_dir, 'master.txt')
+        with open(new_terms_filename, 'w', encoding='utf-8') as to_f:
+            to_f.write(''.join(f'{term}\n' for term in terms))
+        with open(master_terms_filename, 'w', encoding='utf-8') as to_f:
+            to_f.write(''.join(f'{line}\n' for line in make_master_lines(rng, terms, n_master)))
+        result = {'stage': 'cold_start_only_find_duplicates_run', 'size': n_terms}
+        result['wall_time'] = time_process([
+            sys.executable, os.path.join(code_dir, 'only_find_duplicates.py'),
+            '--new_terms_filename', new_terms_filename,
+            '--master_terms_filename', master_terms_filename,
+            '--target_filepath', os.path.join(tmp_dir, 'duplicates.txt')
+            ], code_dir)
+    print(json.dumps(result))
+    results.append(result)
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline_results):
+    """Print time and memory ratios of results against a baseline benchmark file."""
+    baseline = {(r['stage'], r['size']): r for r in baseline_results if 'skipped' not in r}
+    for result in results:
+        old = baseline.get((result['stage'], result['size']))
+        if old is None or 'skipped' in result:
+            continue
+        line = f"{result['stage']}\t{result['size']}\ttime x{result['wall_time'] / old['wall_time']:.2f}"
+        if result.get('peak_memory') and old.get('peak_memory'):
+            line += f"\tmemory x{result['peak_memory'] / old['peak_memory']:.2f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES))
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare')  # earlier benchmark json to print ratios against
+    parser.add_argument('--no_memory', action='store_true')  # skip the traced call measuring peak memory
+    parser.add_argument('--no_limits', action='store_true')  # also run sizes above the stage limits
+    parser.add_argument('--no_cold_start', action='store_true')  # skip timing script start-up in new processes
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stages = args.stages.split(',')
+    results = run_benchmarks(stages, sizes, args.seed, not args.no_memory, args.no_limits)
+    if not args.no_cold_start:
+        results += run_cold_start_benchmarks(args.seed)
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'seed': args.seed,
+        'results': results
+        }
+    with open(args.output, 'w', encoding='utf-8') as to_f:
+        json.dump(report, to_f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as from_f:
+            compare_results(results, json.load(from_f)['results'])
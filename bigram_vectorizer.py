@@ -0,0 +1,137 @@
+import re
+import numpy as np
+import scipy.sparse as sp
+
+from find_duplicates import NGRAM_REMOVED_CHARS
+from find_duplicates import normalize_rows
+
+
+# bits per character of a packed bigram, enough for any unicode code point
+CHAR_BITS = 21
+# odd 64-bit constant used to spread bigram codes over the hashed columns
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def get_bigram_codes(terms):
+    """Return (rows, codes) of the character bigrams found by ngrams() in each term.
+
+    A bigram is packed into one integer, first character in the high bits,
+    so sorting the codes sorts the bigrams like strings.
+    """
+    removed_chars = re.compile(NGRAM_REMOVED_CHARS)
+    cleaned = [removed_chars.sub('', term) for term in terms]
+    lengths = np.fromiter((len(term) for term in cleaned), dtype=np.int64, count=len(cleaned))
+    chars = np.frombuffer(
+        ''.join(cleaned).encode('utf-32-le', errors='surrogatepass'),
+        dtype=np.uint32
+        ).astype(np.uint64)
+    char_rows = np.repeat(np.arange(len(terms)), lengths)
+
+    same_term = char_rows[:-1] == char_rows[1:]
+    codes = (chars[:-1] << np.uint64(CHAR_BITS)) | chars[1:]
+    return char_rows[:-1][same_term], codes[same_term]
+
+
+def hash_bigram_codes(codes, n_features):
+    hashed = codes * HASH_MULTIPLIER
+    hashed ^= hashed >> np.uint64(29)
+    return (hashed % np.uint64(n_features)).astype(np.int64)
+
+
+def decode_bigram(code):
+    code = int(code)
+    return chr(code >> CHAR_BITS) + chr(code & ((1 << CHAR_BITS) - 1))
+
+
+def encode_bigrams(bigrams):
+    """Pack bigram strings into codes, as get_bigram_codes does."""
+    return np.array([(ord(bigram[0]) << CHAR_BITS) | ord(bigram[1]) for bigram in bigrams], dtype=np.uint64)
+
+
+class BigramVectorizer:
+    """Same tf-idf matrices as TfidfVectorizer(min_df=1, analyzer=ngrams),
+    computed with numpy over all terms at once instead of a Python callback per term.
+
+    The vocabulary is kept as a sorted array of packed bigram codes, so columns
+    come in the same order as TfidfVectorizer's. With n_features, bigrams are
+    hashed into that many columns instead: nothing grows with the glossary and
+    matrices of different term lists share columns without a fitted vocabulary.
+    Colliding bigrams then share a column, and columns never seen while fitting
+    get a zero idf, so they are dropped on transform like unknown bigrams.
+    """
+
+    def __init__(self, n_features=None):
+        self.n_features = n_features
+        self.bigrams_ = None
+        self.idf_ = None
+
+    @property
+    def vocabulary_(self):
+        """Bigram -> column, as in TfidfVectorizer; not available when hashing."""
+        return {decode_bigram(code): column for column, code in enumerate(self.bigrams_)}
+
+    def count_bigrams(self, terms, fit=False):
+        rows, codes = get_bigram_codes(terms)
+        if self.n_features is not None:
+            cols = hash_bigram_codes(codes, self.n_features)
+        elif fit:
+            self.bigrams_, first_seen, cols = np.unique(codes, return_index=True, return_inverse=True)
+            if not len(self.bigrams_):
+                raise ValueError('empty vocabulary; perhaps the documents only contain stop words')
+            # TfidfVectorizer leaves each row's columns in the order the bigrams were
+            # first seen, so count in that order and relabel to sorted columns afterwards
+            column_of_seen = np.argsort(first_seen, kind='stable')
+            seen_order = np.empty_like(column_of_seen)
+            seen_order[column_of_seen] = np.arange(len(column_of_seen))
+            cols = seen_order[cols]
+        else:
+            cols = np.searchsorted(self.bigrams_, codes)
+            known = cols < len(self.bigrams_)
+            known[known] = self.bigrams_[cols[known]] == codes[known]
+            rows, cols = rows[known], cols[known]
+
+        n_features = self.n_features if self.n_features is not None else len(self.bigrams_)
+        counts = sp.csr_matrix(
+            (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+            shape=(len(terms), n_features)
+            )
+        counts.sum_duplicates()
+        if fit and self.n_features is None:
+            counts.indices = column_of_seen[counts.indices].astype(counts.indices.dtype)
+            counts.has_sorted_indices = False
+        return counts
+
+    @classmethod
+    def from_vocabulary(cls, vocabulary, idf):
+        """Return the vectorizer equal to a fitted TfidfVectorizer over ngrams,
+        given its bigrams in column order and its idf; None if the vocabulary
+        holds anything else than bigrams sorted by code point."""
+        if any(len(bigram) != 2 for bigram in vocabulary):
+            return None
+        bigrams = encode_bigrams(vocabulary)
+        if np.any(bigrams[1:] <= bigrams[:-1]):
+            return None
+        vectorizer = cls()
+        vectorizer.bigrams_ = bigrams
+        vectorizer.idf_ = idf
+        return vectorizer
+
+    def fit_transform(self, terms):
+        counts = self.count_bigrams(terms, fit=True)
+        doc_freq = np.bincount(counts.indices, minlength=counts.shape[1]).astype(np.float64)
+        # smoothed idf, computed in the same order of operations as TfidfTransformer
+        self.idf_ = np.full_like(doc_freq, fill_value=counts.shape[0] + 1)
+        self.idf_ /= doc_freq + 1.0
+        np.log(self.idf_, out=self.idf_)
+        self.idf_ += 1.0
+        if self.n_features is not None:
+            self.idf_[doc_freq == 0] = 0
+        return self.weight(counts)
+
+    def transform(self, terms):
+        return self.weight(self.count_bigrams(terms))
+
+    def weight(self, counts):
+        counts.data *= self.idf_[counts.indices]
+        counts.eliminate_zeros()
+        return normalize_rows(counts)
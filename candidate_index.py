@@ -0,0 +1,201 @@
+import json
+import numpy as np
+import scipy.sparse as sp
+
+from find_duplicates import top_k_rows
+from find_duplicates import normalize_rows
+from find_duplicates import get_best_master_matches
+
+
+# suffix norms are compared with a small margin so that rounding
+# never drops a pair sitting exactly on the threshold
+NORM_MARGIN = 1e-6
+
+
+def get_feature_ranks(*tf_idf_matrices):
+    """Rank n-gram features from the rarest to the most common one."""
+    doc_freq = sum(np.bincount(m.indices, minlength=m.shape[1]) for m in tf_idf_matrices)
+    order = np.argsort(doc_freq, kind='stable')
+    feature_ranks = np.empty_like(order)
+    feature_ranks[order] = np.arange(len(order))
+    return feature_ranks
+
+
+def get_prefix_matrix(tf_idf_matrix, feature_ranks, threshold=0.8):
+    """Return the binary inverted-index entries of each term.
+
+    A term's n-grams are taken rarest first until the remaining ones have
+    an L2 norm below threshold. Two unit vectors whose prefixes (built with
+    the same feature_ranks) share no n-gram cannot score above threshold,
+    so only terms sharing a prefix n-gram need to be compared.
+    """
+    n_terms = tf_idf_matrix.shape[0]
+    row_lengths = np.diff(tf_idf_matrix.indptr)
+    rows = np.repeat(np.arange(n_terms), row_lengths)
+    # most common n-grams first, so a running sum gives the norm of the suffix
+    order = np.lexsort((-feature_ranks[tf_idf_matrix.indices], rows))
+    cumulative = np.cumsum(tf_idf_matrix.data[order] ** 2)
+    row_offsets = np.concatenate([[0], cumulative])[tf_idf_matrix.indptr[:-1]]
+    suffix_norms = np.sqrt(np.maximum(cumulative - np.repeat(row_offsets, row_lengths), 0))
+    in_prefix = suffix_norms >= threshold - NORM_MARGIN
+
+    prefix_rows = rows[order][in_prefix]
+    prefix_cols = tf_idf_matrix.indices[order][in_prefix]
+    return sp.csr_matrix(
+        (np.ones(len(prefix_rows), dtype=np.int32), (prefix_rows, prefix_cols)),
+        shape=tf_idf_matrix.shape
+        )
+
+
+def score_pairs(tf_idf_matrix, other_tf_idf_matrix, rows, cols):
+    """Return the exact cosine similarity of each (row, col) pair."""
+    if not len(rows):
+        return np.zeros(0)
+    products = tf_idf_matrix[rows].multiply(other_tf_idf_matrix[cols])
+    return np.asarray(products.sum(axis=1)).ravel()
+
+
+def get_internal_candidate_similarities(tf_idf_matrix, threshold=0.8, top_k=None, block_size=1_000):
+    """Same result as get_internal_similarities, scoring only candidate pairs.
+
+    Candidates are terms sharing an inverted-index entry, see get_prefix_matrix.
+    """
+    tf_idf_matrix = normalize_rows(tf_idf_matrix)
+    n_terms = tf_idf_matrix.shape[0]
+    prefix_matrix = get_prefix_matrix(tf_idf_matrix, get_feature_ranks(tf_idf_matrix), threshold)
+    prefix_transposed = prefix_matrix.T.tocsc()
+
+    rows, cols, scores = [], [], []
+    for start_idx in range(0, n_terms, block_size):
+        end_idx = min(start_idx + block_size, n_terms)
+        candidates = (prefix_matrix[start_idx:end_idx] @ prefix_transposed).tocoo()
+        block_rows = candidates.row + start_idx
+        cond = candidates.col > block_rows
+        block_rows, block_cols = block_rows[cond], candidates.col[cond]
+        block_scores = score_pairs(tf_idf_matrix, tf_idf_matrix, block_rows, block_cols)
+        cond = block_scores > threshold
+        rows.append(block_rows[cond])
+        cols.append(block_cols[cond])
+        scores.append(block_scores[cond])
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=np.int64)
+    scores = np.concatenate(scores) if scores else np.array([], dtype=np.float64)
+    return top_k_rows(rows, cols, scores, n_terms, n_terms, top_k=top_k)
+
+
+def get_master_prefix_index(old_tf_idf_matrix, threshold=0.8, feature_ranks=None):
+    """Return what get_best_master_candidate_matches needs of the master: its normalized
+    matrix, the feature ranks and its transposed prefix matrix.
+
+    Any fixed ranking keeps the candidates exact, so one built from the master
+    alone can be kept and reused for every query, as the lookup server does.
+    """
+    old_tf_idf_matrix = normalize_rows(old_tf_idf_matrix)
+    if feature_ranks is None:
+        feature_ranks = get_feature_ranks(old_tf_idf_matrix)
+    return {
+        'matrix': old_tf_idf_matrix,
+        'feature_ranks': feature_ranks,
+        # csr, which the product with the terms' prefixes would otherwise convert to on every call
+        'prefix_transposed': get_prefix_matrix(old_tf_idf_matrix, feature_ranks, threshold).T.tocsr()
+        }
+
+
+def get_best_master_candidate_matches(tf_idf_matrix, old_tf_idf_matrix, threshold=0.8, block_size=1_000,
+                                      master_prefix_index=None):
+    """Same result as get_best_master_matches, scoring only candidate pairs.
+
+    master_prefix_index, from get_master_prefix_index with the same threshold,
+    replaces old_tf_idf_matrix; without it one is built for these terms.
+    """
+    tf_idf_matrix = normalize_rows(tf_idf_matrix)
+    if master_prefix_index is None:
+        master_prefix_index = get_master_prefix_index(
+            old_tf_idf_matrix, threshold, get_feature_ranks(tf_idf_matrix, old_tf_idf_matrix)
+            )
+    old_tf_idf_matrix = master_prefix_index['matrix']
+    n_terms, n_old_terms = tf_idf_matrix.shape[0], old_tf_idf_matrix.shape[0]
+    prefix_matrix = get_prefix_matrix(tf_idf_matrix, master_prefix_index['feature_ranks'], threshold)
+    old_prefix_transposed = master_prefix_index['prefix_transposed']
+
+    rows, cols, scores = [], [], []
+    for start_idx in range(0, n_terms, block_size):
+        end_idx = min(start_idx + block_size, n_terms)
+        candidates = (prefix_matrix[start_idx:end_idx] @ old_prefix_transposed).tocoo()
+        block_rows = candidates.row + start_idx
+        block_scores = score_pairs(tf_idf_matrix, old_tf_idf_matrix, block_rows, candidates.col)
+        cond = block_scores > threshold
+        rows.append(block_rows[cond])
+        cols.append(candidates.col[cond])
+        scores.append(block_scores[cond])
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=np.int64)
+    scores = np.concatenate(scores) if scores else np.array([], dtype=np.float64)
+    best = top_k_rows(rows, cols, scores, n_terms, n_old_terms, top_k=1)
+
+    best_ids = np.full(n_terms, -1, dtype=np.int64)
+    best_scores = np.zeros(n_terms)
+    has_duplicates = np.diff(best.indptr) > 0
+    best_ids[has_duplicates] = best.indices[best.indptr[:-1][has_duplicates]]
+    best_scores[has_duplicates] = best.data[best.indptr[:-1][has_duplicates]]
+    return best_ids, best_scores
+
+
+def sample_terms(n_terms, sample_size, seed):
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n_terms, size=min(sample_size, n_terms), replace=False))
+
+
+def internal_recall_report(tf_idf_matrix, neighbours, threshold=0.8, sample_size=1_000, seed=0):
+    """Compare candidate neighbours with brute force on a sample of terms."""
+    tf_idf_matrix = normalize_rows(tf_idf_matrix)
+    sample = sample_terms(tf_idf_matrix.shape[0], sample_size, seed)
+    brute_force = (tf_idf_matrix[sample] @ tf_idf_matrix.T).tocoo()
+    brute_force_rows = sample[brute_force.row]
+    cond = (brute_force.data > threshold) & (brute_force.col > brute_force_rows)
+    expected = set(zip(brute_force_rows[cond].tolist(), brute_force.col[cond].tolist()))
+
+    found = 0
+    for i, j in expected:
+        row = neighbours.indices[neighbours.indptr[i]:neighbours.indptr[i + 1]]
+        if j in row:
+            found += 1
+
+    return {
+        'stage': 'internal',
+        'sampled_terms': len(sample),
+        'expected_pairs': len(expected),
+        'found_pairs': found,
+        'recall': found / len(expected) if expected else 1.0
+        }
+
+
+def master_recall_report(tf_idf_matrix, old_tf_idf_matrix, best_matches, sample_size=1_000, seed=0):
+    """Compare candidate best master matches with brute force on a sample of terms.
+
+    A match counts as found when it has the brute-force index or the same score,
+    which covers ties between equally similar master terms.
+    """
+    sample = sample_terms(tf_idf_matrix.shape[0], sample_size, seed)
+    expected_ids, expected_scores = get_best_master_matches(tf_idf_matrix[sample], old_tf_idf_matrix)
+    best_ids, best_scores = best_matches[0][sample], best_matches[1][sample]
+
+    has_expected = expected_ids >= 0
+    same_match = (best_ids == expected_ids) | np.isclose(best_scores, expected_scores, rtol=0, atol=1e-9)
+    found = int(np.sum(has_expected & same_match))
+    expected = int(np.sum(has_expected))
+
+    return {
+        'stage': 'vs_master',
+        'sampled_terms': len(sample),
+        'expected_matches': expected,
+        'found_matches': found,
+        'recall': found / expected if expected else 1.0
+        }
+
+
+def write_recall_report(reports, filename):
+    with open(filename, 'w', encoding='utf-8') as to_f:
+        json.dump(reports, to_f, indent=2)
@@ -0,0 +1,236 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from candidate_index import score_pairs
+from find_duplicates import cutoff_label
+from find_duplicates import find_term_spans
+from find_duplicates import get_internal_block_size
+from find_duplicates import highlight_spans
+from find_duplicates import normalize_rows
+from find_duplicates import remove_newlines
+from postprocess import to_lower
+
+
+CLUSTER_DTYPE = np.dtype([
+    ('cluster', np.int32),
+    ('node', np.int64),  # new term idx, or n_terms + master idx
+    ('representative', np.int64),
+    ('score', np.float64)  # similarity to the representative
+    ])
+
+
+def get_master_neighbours(unit_matrix, old_transposed, threshold=0.8):
+    """Return rows, master ids and scores of all pairs of a row of unit_matrix and
+    a master term scoring above threshold, block by block as get_internal_similarities.
+    Scores are rounded to three decimals for the threshold, as in find_duplicates_vs_master."""
+    n_rows, n_master_terms = unit_matrix.shape[0], old_transposed.shape[1]
+    block_size = get_internal_block_size(n_master_terms)
+    rows, cols, scores = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    for start_idx in range(0, n_rows, block_size):
+        cos_sim_block = (unit_matrix[start_idx:start_idx + block_size] @ old_transposed).tocoo()
+        cond = np.round(cos_sim_block.data, 3) > threshold
+        rows.append(cos_sim_block.row[cond].astype(np.int64) + start_idx)
+        cols.append(cos_sim_block.col[cond].astype(np.int64))
+        scores.append(cos_sim_block.data[cond].astype(np.float64))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(scores)
+
+
+def get_master_edges(new_tf_idf_matrix, old_tf_idf_matrix, threshold=0.8):
+    """Return the edges above threshold of the new terms to the master and within
+    the master, as node rows, node columns and scores.
+
+    Every master term similar to a new term is linked to it, then the
+    master terms similar to those, and so on until no master term is added,
+    so a cluster holds all the master terms it reaches, not only best
+    matches. Master terms not reached from a new term are never compared.
+    """
+    n_terms = new_tf_idf_matrix.shape[0]
+    unit_old = normalize_rows(old_tf_idf_matrix)
+    old_transposed = unit_old.T.tocsr()
+    rows, cols, scores = get_master_neighbours(normalize_rows(new_tf_idf_matrix), old_transposed, threshold)
+    edges = [(rows, cols + n_terms, scores)]
+
+    reached = np.zeros(unit_old.shape[0], dtype=bool)
+    frontier = np.unique(cols)
+    reached[frontier] = True
+    master_pairs = []
+    while len(frontier):
+        rows, cols, scores = get_master_neighbours(unit_old[frontier], old_transposed, threshold)
+        rows = frontier[rows]
+        master_pairs.append((rows, cols, scores))
+        frontier = np.unique(cols[~reached[cols]])
+        reached[frontier] = True
+
+    if master_pairs:
+        rows, cols, scores = (np.concatenate(parts) for parts in zip(*master_pairs))
+        # each pair once, as the graph is made symmetric later; no self-loops
+        keep = rows < cols
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+        _, first = np.unique(rows * unit_old.shape[0] + cols, return_index=True)
+        edges.append((rows[first] + n_terms, cols[first] + n_terms, scores[first]))
+    return tuple(np.concatenate(parts) for parts in zip(*edges))
+
+
+def get_duplicate_graph(neighbours, master_edges, n_master_terms, cutoff_sim=0.99):
+    """Return the undirected graph of duplicates above cutoff_sim over new and master terms.
+
+    Nodes 0..n_terms-1 are the new terms and the following n_master_terms
+    nodes the master terms. Internal edges are all forward neighbours above
+    the cutoff, the others come from get_master_edges. The cutoffs are
+    applied as in find_internal_duplicates and find_duplicates_vs_master.
+    """
+    n_terms = neighbours.shape[0]
+    neighbours = sp.coo_matrix(neighbours)
+    internal = neighbours.data > cutoff_sim
+    master_rows, master_cols, master_scores = master_edges
+    master = np.round(master_scores, 3) > cutoff_sim
+
+    rows = np.concatenate([neighbours.row[internal], master_rows[master]])
+    cols = np.concatenate([neighbours.col[internal], master_cols[master]])
+    scores = np.concatenate([neighbours.data[internal], master_scores[master]])
+    n_nodes = n_terms + n_master_terms
+    graph = sp.csr_matrix((scores, (rows, cols)), shape=(n_nodes, n_nodes))
+    return (graph + graph.T).tocsr()
+
+
+def get_duplicate_clusters(graph, n_terms):
+    """Return the CLUSTER_DTYPE records of all connected components with two or more terms,
+    at least one of them new; master terms only linked to each other are no cluster.
+
+    A cluster is represented by its first master term if it has one, else by
+    the new term with the highest sum of similarities to its neighbours.
+    Clusters are ordered by size, largest first, then by their first node;
+    the representative comes first and the score is left to set_cluster_scores.
+    """
+    n_nodes = graph.shape[0]
+    is_new = np.arange(n_nodes) < n_terms
+    _, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels)
+    has_new = np.bincount(labels, weights=is_new) > 0
+    nodes = np.flatnonzero((sizes[labels] > 1) & has_new[labels])
+    if not len(nodes):
+        return np.zeros(0, dtype=CLUSTER_DTYPE)
+
+    strength = np.asarray(graph.sum(axis=1)).ravel()
+    # per component: master terms first, by index, then new terms by strength
+    rank_key = np.where(is_new, -strength, 0.0)
+    order = np.lexsort((nodes, rank_key[nodes], is_new[nodes], labels[nodes]))
+    nodes = nodes[order]
+    node_labels = labels[nodes]
+    starts = np.flatnonzero(np.r_[True, node_labels[1:] != node_labels[:-1]])
+    representatives = np.repeat(nodes[starts], np.diff(np.r_[starts, len(nodes)]))
+
+    # components largest first; connected_components numbers them by first node
+    component_order = np.lexsort((node_labels[starts], -sizes[node_labels[starts]]))
+    cluster_of_component = np.empty(len(sizes), dtype=np.int64)
+    cluster_of_component[node_labels[starts][component_order]] = np.arange(len(starts))
+
+    records = np.zeros(len(nodes), dtype=CLUSTER_DTYPE)
+    records['cluster'] = cluster_of_component[node_labels]
+    records['node'] = nodes
+    records['representative'] = representatives
+    return records[np.argsort(records['cluster'], kind='stable')]
+
+
+def set_cluster_scores(records, n_terms, tf_idf_matrix, new_tf_idf_matrix, old_tf_idf_matrix):
+    """Set the similarity of each member to its cluster's representative, then put
+    members in order of that score.
+
+    New terms are compared in the internal tf-idf space (tf_idf_matrix) and
+    any pair with a master term in the master's (new_tf_idf_matrix vs
+    old_tf_idf_matrix), so the scores agree with those of the 02_ and 03_ files.
+    """
+    nodes, representatives = records['node'], records['representative']
+    node_new, representative_new = nodes < n_terms, representatives < n_terms
+    scores = np.ones(len(records))
+
+    pairs = node_new & representative_new
+    scores[pairs] = score_pairs(tf_idf_matrix, tf_idf_matrix, nodes[pairs], representatives[pairs])
+    pairs = node_new & ~representative_new
+    scores[pairs] = score_pairs(new_tf_idf_matrix, old_tf_idf_matrix, nodes[pairs], representatives[pairs] - n_terms)
+    pairs = ~node_new & representative_new
+    scores[pairs] = score_pairs(new_tf_idf_matrix, old_tf_idf_matrix, representatives[pairs], nodes[pairs] - n_terms)
+    pairs = ~node_new & ~representative_new
+    scores[pairs] = score_pairs(old_tf_idf_matrix, old_tf_idf_matrix, nodes[pairs] - n_terms, representatives[pairs] - n_terms)
+
+    records['score'] = np.where(nodes == representatives, 1.0, scores)
+    is_representative = nodes == representatives
+    order = np.lexsort((nodes, -records['score'], ~is_representative, records['cluster']))
+    return records[order]
+
+
+def iter_cluster_fields(records, terms, old_terms_cased, n_terms):
+    """Yield the columns of each member: cluster, idx, term, source and score,
+    with no score on the representative."""
+    scores = np.round(records['score'], 3).tolist()
+    for (cluster, node, representative), score in zip(records[['cluster', 'node', 'representative']].tolist(), scores):
+        if node < n_terms:
+            fields = [str(cluster), str(node), terms[node], 'new']
+        else:
+            fields = [str(cluster), str(node - n_terms), old_terms_cased[node - n_terms], 'master']
+        fields.append('' if node == representative else str(score))
+        yield node, fields
+
+
+def format_clusters(records, terms, old_terms_cased, n_terms):
+    """Return the lines of a 04_duplicate_clusters file."""
+    lines = ['cluster\tidx\tterm\tsource\tsim_score\n']
+    for _, fields in iter_cluster_fields(records, terms, old_terms_cased, n_terms):
+        lines.append('\t'.join(fields) + '\n')
+    return lines
+
+
+def write_clusters_html(filename, records, terms, old_terms_cased, n_terms, terms_contexts_uniq):
+    """Write the clusters as one table, each new term with its first highlighted context."""
+    with open(filename, 'w', encoding='utf-8') as to_f:
+        to_f.write("<table border='1'>\n")
+        to_f.write('<tr><th>Cluster</th><th>Index</th><th>Term</th><th>Source</th><th>Score</th><th>Context</th></tr>\n')
+        last_cluster = None
+        for node, fields in iter_cluster_fields(records, terms, old_terms_cased, n_terms):
+            cluster, idx, term, source, score = fields
+            context = ''
+            if node < n_terms:
+                contexts = terms_contexts_uniq.get(term, {}).get('contexts') or ['']
+                context = remove_newlines(contexts[0])
+                context = highlight_spans(context, find_term_spans(to_lower(term), context))
+            if cluster == last_cluster:
+                cluster = ' '
+            else:
+                last_cluster = cluster
+                term = f'<b>{term}</b>'  # the representative
+            to_f.write(
+                f'<tr><td>{cluster}</td><td>{idx}</td><td>{term}</td><td>{source}</td>'
+                f'<td>{score}</td><td>{context}</td></tr>\n'
+                )
+        to_f.write('</table>\n')
+
+
+def save_duplicate_clusters(neighbours, tf_idf_matrix, new_tf_idf_matrix, old_tf_idf_matrix,
+                            terms, old_terms_cased, terms_contexts_uniq, sub_dir, main_output_path, cutoffs):
+    """Write the 04_duplicate_clusters TSV and clusters HTML report of each cutoff; return cluster counts."""
+    n_terms = len(terms)
+    # gathered once above the master match threshold, each cutoff only drops edges
+    master_edges = get_master_edges(new_tf_idf_matrix, old_tf_idf_matrix)
+    counts = []
+    for cutoff_sim in cutoffs:
+        graph = get_duplicate_graph(neighbours, master_edges, len(old_terms_cased), cutoff_sim)
+        records = get_duplicate_clusters(graph, n_terms)
+        records = set_cluster_scores(records, n_terms, tf_idf_matrix, new_tf_idf_matrix, old_tf_idf_matrix)
+
+        label = cutoff_label(cutoff_sim)
+        file_name = os.path.join(sub_dir, f'04_duplicate_clusters_{label}_cutoff.txt')
+        with open(file_name, 'w', encoding='utf-8') as to_f:
+            for line in format_clusters(records, terms, old_terms_cased, n_terms):
+                to_f.write(line)
+        write_clusters_html(
+            os.path.join(main_output_path, f'clusters_{label}_percent.html'),
+            records, terms, old_terms_cased, n_terms, terms_contexts_uniq
+            )
+        counts.append({
+            'cutoff': cutoff_sim,
+            'clusters': int(len(np.unique(records['cluster']))),
+            'clustered_terms': int(np.count_nonzero(records['node'] < n_terms))
+            })
+    return counts
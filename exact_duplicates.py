@@ -0,0 +1,119 @@
+from collections import Counter
+from math import gcd
+import numpy as np
+import scipy.sparse as sp
+
+from find_duplicates import ngrams
+from find_duplicates import top_k_rows
+
+
+def get_normalized_key(term_lower):
+    """Return the bigram counts of a term divided by their greatest common divisor.
+
+    Terms have the same key exactly when their tf-idf vectors point the same
+    way, so they are duplicates with a similarity of 1.0 without being
+    scored. This includes terms that are not the same string, such as
+    'supplysafety' and 'safetysupply', which tie in the brute-force scores
+    too. Hashed columns (--hash_features) can tie further terms by collision.
+    """
+    counts = Counter(ngrams(term_lower))
+    divisor = gcd(*counts.values()) if counts else 1
+    return tuple(sorted((bigram, count // divisor) for bigram, count in counts.items()))
+
+
+def get_exact_groups(terms_lower):
+    """Return (groups, representatives): the group of each term, and the first term of each group.
+
+    Terms share a group when they have the same normalized key. A term
+    without bigrams gives an empty vector that matches nothing, so such terms
+    each get a group of their own.
+    """
+    group_of_key = {}
+    groups = np.empty(len(terms_lower), dtype=np.int64)
+    representatives = []
+    for term_idx, term in enumerate(terms_lower):
+        key = get_normalized_key(term)
+        if not key:
+            key = term_idx  # never shared with another term
+        group = group_of_key.setdefault(key, len(group_of_key))
+        if group == len(representatives):
+            representatives.append(term_idx)
+        groups[term_idx] = group
+    return groups, np.array(representatives, dtype=np.int64)
+
+
+def ragged_arange(counts):
+    """Return 0..counts[0]-1, 0..counts[1]-1, ... as one array."""
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def expand_group_neighbours(group_neighbours, groups, top_k=None):
+    """Turn neighbours scored between group representatives into neighbours of all terms.
+
+    group_neighbours holds the forward neighbours of the representatives, as
+    returned by get_internal_similarities on their rows. The result is what
+    get_internal_similarities returns on all terms: each term gets every later
+    member of the similar groups, and every later member of its own group as
+    an exact duplicate with a score of 1.0.
+    """
+    n_terms = len(groups)
+    n_groups = group_neighbours.shape[0]
+    group_neighbours = sp.csr_matrix(group_neighbours)
+    # scores between groups in both directions, plus each group with itself
+    group_scores = (group_neighbours + group_neighbours.T + sp.identity(n_groups, format='csr')).tocsr()
+
+    # (term, similar group) pairs
+    degrees = np.diff(group_scores.indptr)[groups]
+    pair_terms = np.repeat(np.arange(n_terms), degrees)
+    pair_positions = np.repeat(group_scores.indptr[:-1][groups], degrees) + ragged_arange(degrees)
+    pair_groups = group_scores.indices[pair_positions]
+    pair_scores = group_scores.data[pair_positions]
+
+    # members sorted by group then index, so the members of a group
+    # following a term come right after the key group * n_terms + term
+    members = np.lexsort((np.arange(n_terms), groups))
+    member_keys = groups[members] * n_terms + members
+    group_ends = np.searchsorted(member_keys, (np.arange(n_groups) + 1) * n_terms)
+    starts = np.searchsorted(member_keys, pair_groups * n_terms + pair_terms, side='right')
+    counts = group_ends[pair_groups] - starts
+
+    rows = np.repeat(pair_terms, counts)
+    cols = members[np.repeat(starts, counts) + ragged_arange(counts)]
+    scores = np.repeat(pair_scores, counts)
+    return top_k_rows(rows, cols, scores, n_terms, n_terms, top_k=top_k)
+
+
+def get_exact_master_matches(terms_lower, old_terms_cased):
+    """Return the first master term with the same normalized key as each term, -1 if none.
+
+    All master terms with that key score the same 1.0, so the first one is
+    also the match brute-force scoring picks among the ties.
+    """
+    first_of_key = {}
+    for old_idx, line in enumerate(old_terms_cased):
+        key = get_normalized_key(line.split('|')[0].strip().lower())  # as in load_master_terms
+        if key:
+            first_of_key.setdefault(key, old_idx)
+    return np.array([first_of_key.get(get_normalized_key(term), -1) for term in terms_lower], dtype=np.int64)
+
+
+def get_master_scored_terms(representatives, exact_ids):
+    """Return the terms still to be scored against the master: one per group without an exact hit."""
+    return representatives[exact_ids[representatives] < 0]
+
+
+def expand_group_master_matches(best_matches, scored_terms, groups, exact_ids):
+    """Give every term the best master match of its group's representative,
+    or its exact master hit with a score of 1.0."""
+    scored_ids, scored_scores = best_matches
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    group_ids = np.full(n_groups, -1, dtype=np.int64)
+    group_scores = np.zeros(n_groups, dtype=scored_scores.dtype)
+    group_ids[groups[scored_terms]] = scored_ids
+    group_scores[groups[scored_terms]] = scored_scores
+
+    best_ids, best_scores = group_ids[groups], group_scores[groups]
+    exact = exact_ids >= 0
+    best_ids[exact] = exact_ids[exact]
+    best_scores[exact] = 1.0
+    return best_ids, best_scores
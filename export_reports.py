@@ -0,0 +1,192 @@
+import importlib.util
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape
+import numpy as np
+
+from find_duplicates import DUPLICATES_DTYPE
+
+
+# fixed schema of the export, whatever columns a cutoff's rows happen to use
+EXPORT_SCHEMA = [
+    ('idx', 'int32'),
+    ('term', 'string'),
+    ('source_file', 'string'),
+    ('master_match', 'string'),
+    ('master_score', 'float64'),
+    ('master_exact', 'bool_'),
+    ('internal_idx', 'int32'),
+    ('internal_match', 'string'),
+    ('internal_score', 'float64'),
+    ('internal_exact', 'bool_'),
+    ('cutoff', 'float64')
+    ]
+EXPORT_FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.xlsx': 'xlsx'}
+XLSX_MAX_ROWS = 1_048_576
+XLSX_ROWS_PER_WRITE = 10_000
+# characters XML 1.0 does not allow, even escaped
+XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def check_export_filename(filename):
+    """Raise ValueError if filename cannot be exported to, before any scoring is done:
+    the extension must be one of EXPORT_FORMATS, and Parquet and Arrow need pyarrow."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f'unknown export format {extension!r}, use one of {", ".join(EXPORT_FORMATS)}')
+    if EXPORT_FORMATS[extension] != 'xlsx' and importlib.util.find_spec('pyarrow') is None:
+        raise ValueError(f'writing {filename} needs pyarrow: pip install pyarrow')
+
+
+def get_export_columns(vs_master, cutoffs, terms, old_terms_cased, terms_contexts_uniq):
+    """Return {column: values} of the rows of every duplicates_*_percent file, one cutoff after the other.
+
+    Missing master and internal matches are None; scores are rounded
+    to three decimals, as in the text reports, and *_exact tells the
+    matches resolved by the exact pre-pass.
+    """
+    records = np.concatenate(vs_master) if vs_master else np.zeros(0, dtype=DUPLICATES_DTYPE)
+    idx = records['idx'].tolist()
+    master_idx = records['master_idx'].tolist()
+    internal_idx = records['internal_idx'].tolist()
+    master_scores = np.round(records['master_score'], 3).tolist()
+    internal_scores = np.round(records['internal_score'], 3).tolist()
+    master_exact = records['master_exact'].tolist()
+    internal_exact = records['internal_exact'].tolist()
+    return {
+        'idx': idx,
+        'term': [terms[i] for i in idx],
+        'source_file': [terms_contexts_uniq[terms[i]]['filename'] for i in idx],
+        'master_match': [old_terms_cased[i] if i >= 0 else None for i in master_idx],
+        'master_score': [score if i >= 0 else None for i, score in zip(master_idx, master_scores)],
+        'master_exact': [exact if i >= 0 else None for i, exact in zip(master_idx, master_exact)],
+        'internal_idx': [i if i >= 0 else None for i in internal_idx],
+        'internal_match': [terms[i] if i >= 0 else None for i in internal_idx],
+        'internal_score': [score if i >= 0 else None for i, score in zip(internal_idx, internal_scores)],
+        'internal_exact': [exact if i >= 0 else None for i, exact in zip(internal_idx, internal_exact)],
+        'cutoff': np.repeat(np.array(cutoffs, dtype=np.float64), [len(records) for records in vs_master]).tolist()
+        }
+
+
+def write_arrow_export(columns, filename, file_format):
+    """Write the columns as a Parquet or Arrow IPC file; needs pyarrow."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError(f'writing {filename} needs pyarrow: pip install pyarrow') from None
+    schema = pa.schema([(name, pa.string() if type_name == 'string' else getattr(pa, type_name)())
+                        for name, type_name in EXPORT_SCHEMA])
+    table = pa.table({name: pa.array(columns[name], type=schema.field(name).type) for name in schema.names},
+                     schema=schema)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, filename)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, filename, compression='uncompressed')
+
+
+def get_xlsx_column_name(column_idx):
+    name = ''
+    column_idx += 1
+    while column_idx:
+        column_idx, remainder = divmod(column_idx - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+def format_xlsx_cell(reference, value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        text = escape(XML_ILLEGAL_CHARS.sub('', value))
+        return f'<c r="{reference}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+    if isinstance(value, bool):
+        return f'<c r="{reference}" t="b"><v>{int(value)}</v></c>'
+    return f'<c r="{reference}"><v>{value!r}</v></c>'
+
+
+XLSX_PACKAGE_FILES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+        ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+        ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="duplicates" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+        ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+        )
+    }
+
+
+def write_xlsx_export(columns, filename):
+    """Write the columns as a one-sheet XLSX workbook, streaming the rows into the zip
+    instead of building the sheet in memory; numbers are stored as numeric cells."""
+    names = [name for name, _ in EXPORT_SCHEMA]
+    n_rows = len(columns['idx'])
+    if n_rows + 1 > XLSX_MAX_ROWS:
+        raise ValueError(f'{n_rows} rows do not fit in an Excel sheet, export to Parquet instead')
+    letters = [get_xlsx_column_name(column_idx) for column_idx in range(len(names))]
+
+    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as to_zip:
+        for name, content in XLSX_PACKAGE_FILES.items():
+            to_zip.writestr(name, content)
+        with to_zip.open('xl/worksheets/sheet1.xml', 'w') as to_f:
+            to_f.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                )
+            rows = zip(*(columns[name] for name in names))
+            header = ''.join(format_xlsx_cell(f'{letter}1', name) for letter, name in zip(letters, names))
+            to_f.write(f'<row r="1">{header}</row>'.encode('utf-8'))
+            # rows are compressed in batches, many small writes are slow
+            batch = []
+            for row_number, row in enumerate(rows, start=2):
+                cells = ''.join(
+                    format_xlsx_cell(f'{letter}{row_number}', value) for letter, value in zip(letters, row)
+                    )
+                batch.append(f'<row r="{row_number}">{cells}</row>')
+                if len(batch) == XLSX_ROWS_PER_WRITE:
+                    to_f.write(''.join(batch).encode('utf-8'))
+                    batch = []
+            to_f.write(''.join(batch).encode('utf-8'))
+            to_f.write(b'</sheetData></worksheet>')
+
+
+def export_duplicates(filename, vs_master, cutoffs, terms, old_terms_cased, terms_contexts_uniq):
+    """Write the duplicates of all cutoffs with the fixed EXPORT_SCHEMA columns;
+    the format, Parquet, Arrow or XLSX, follows the file extension. Returns the row count."""
+    check_export_filename(filename)
+    extension = os.path.splitext(filename)[1].lower()
+    columns = get_export_columns(vs_master, cutoffs, terms, old_terms_cased, terms_contexts_uniq)
+    if EXPORT_FORMATS[extension] == 'xlsx':
+        write_xlsx_export(columns, filename)
+    else:
+        write_arrow_export(columns, filename, EXPORT_FORMATS[extension])
+    return len(columns['idx'])
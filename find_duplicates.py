@@ -3,11 +3,56 @@ import argparse
 import numpy as np
 import json
 import re
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import scipy.sparse as sp
+
+from metrics import Metrics
+from metrics import matrix_info
+from postprocess import to_lower
+from preprocess import is_jsonl
+from preprocess import iter_jsonl
+from stage_cache import open_cache
+from stage_cache import make_key
+from stage_cache import matrix_to_bytes
+from stage_cache import matrix_from_bytes
+from stage_cache import get_master_key
+from stage_cache import get_cached_master_matches
+
+
+CUTOFFS = [0.99, 0.9, 0.8]
+
+# below this many new terms vectorizing is done with numpy, see uses_native_ngrams
+SMALL_INPUT_LIMIT = 10_000
+
+# bytes of similarity scores computed at once by get_internal_similarities,
+# so the rows per block shrink as the number of terms grows
+INTERNAL_BLOCK_MEMORY = 256 * 2**20
+
+# characters dropped from a term before it is split into n-grams
+NGRAM_REMOVED_CHARS = r'[“”",-./#!&()]|\s'
+
+# one record per reported term; -1 marks a missing master or internal match,
+# *_exact a match resolved by the exact pre-pass instead of being scored
+DUPLICATES_DTYPE = np.dtype([
+    ('idx', np.int32),
+    ('master_idx', np.int32),
+    ('master_score', np.float64),
+    ('master_exact', np.bool_),
+    ('internal_idx', np.int32),
+    ('internal_score', np.float64),
+    ('internal_exact', np.bool_)
+    ])
+
+# appended to the 1.0 score of an exact match in the 03_ and duplicates_ files
+EXACT_MARKER = ' (exact)'
 
 
 def read_unique_terms_contexts(filename):
+    """Read the terms written by postprocess, as a JSON dict or a .jsonl file."""
+    if is_jsonl(filename):
+        return {
+            record['term']: {'contexts': record['contexts'], 'filename': record['filename']}
+            for record in iter_jsonl(filename)
+            }
     with open(filename, 'r', encoding='utf-8') as from_f:
         unique_terms_contexts = json.load(from_f)
     return unique_terms_contexts
@@ -24,73 +69,244 @@ def load_extracted_terms(terms_contexts_uniq):
 
 def ngrams(text, n=2):
     """Return n-grams of a string."""
-    text = re.sub(r'[“”",-./#!&()]|\s', r'', text)
+    text = re.sub(NGRAM_REMOVED_CHARS, r'', text)
     ngrams = zip(*[text[i:] for i in range(n)])
     return [''.join(ngram) for ngram in ngrams]
 
-def get_internal_tf_idf_matrix(terms_lower):
-    vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
+def make_vectorizer(native=False, n_features=None):
+    """Return an unfitted TfidfVectorizer over ngrams, or a BigramVectorizer
+    when native or n_features (hashed columns) is given."""
+    if not native and n_features is None:
+        # scikit-learn takes longer to import than a small check takes to run
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        return TfidfVectorizer(min_df=1, analyzer=ngrams)
+    from bigram_vectorizer import BigramVectorizer
+    return BigramVectorizer(n_features=n_features)
+
+def uses_native_ngrams(native, n_terms, small_input_limit=SMALL_INPUT_LIMIT):
+    """Return whether to vectorize with BigramVectorizer: when asked to, or for
+    fewer than small_input_limit terms, where importing scikit-learn takes longer
+    than the check itself. Both vectorizers give the same matrices."""
+    return native or n_terms < small_input_limit
+
+def get_internal_tf_idf_matrix(terms_lower, native=False, n_features=None):
+    vectorizer = make_vectorizer(native, n_features)
     tf_idf_matrix = vectorizer.fit_transform(terms_lower)
     return tf_idf_matrix
 
-def get_internal_similarities(tf_idf_matrix):
-    return cosine_similarity(tf_idf_matrix)
-
-
-def find_internal_duplicates(terms, cos_sim_table, cutoff_sim=0.99):
-    threshold = 0.8  # below this value, (near-)duplicates are very rare
-
-    range_to_search = cos_sim_table.shape[0]  # number of terms
-    terms = np.array(terms)
-
-    results = []
-    for i in range(range_to_search):
-        curr_term = terms[i]   # terms_df.loc[i]
-        cond = (cos_sim_table[i][i+1:] > threshold)
-        if np.sum(cond) >= 1:
-            similar_ids = np.where(cond)[0] + (i + 1)  # get the indices of similar terms
-            similar_vals = terms[similar_ids]
-            similar_scores = cos_sim_table[i, similar_ids]
-        # if sum(cond) >= 1:
-        #     similar_ids = terms[i+1:][cond].index
-        #     similar_vals = [v for v in terms[i+1:][cond].values]
-        #     similar_scores = cos_sim_table[i][i+1:][cond]
-            idx_max_score = np.argmax(similar_scores)  # index of max scoring duplicate
-            max_score = similar_scores[idx_max_score]
-            if max_score > cutoff_sim:  # this removes (near-)duplicates
-                continue
-            elif max_score > threshold:
-                idx_sim_term = similar_ids[idx_max_score]
-                sim_term = similar_vals[idx_max_score]
-                line = f'{str(i)}\t{curr_term}\t{str(idx_sim_term)}\t{sim_term}\t{str(round(max_score, 3))}'
-        else:
-            line = f'{str(i)}\t{curr_term}'
-
-        results.append(line)
-
-    return results
-
-def get_internal_duplicates(terms, cos_sim_table):
+def select_top_k(rows, cols, scores, top_k=None):
+    """Return the rows, columns and scores of at most top_k best scores per row.
+
+    Ties are broken by the lower column index, like np.argmax does.
+    """
+    if top_k is not None and len(scores):
+        order = np.lexsort((cols, -scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        row_starts = np.searchsorted(rows, rows, side='left')
+        keep = (np.arange(len(rows)) - row_starts) < top_k
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    return rows, cols, scores
+
+
+def top_k_rows(rows, cols, scores, n_rows, n_cols, top_k=None):
+    """Return a csr matrix keeping at most top_k best scores per row, see select_top_k."""
+    rows, cols, scores = select_top_k(rows, cols, scores, top_k)
+    neighbours = sp.csr_matrix((scores, (rows, cols)), shape=(n_rows, n_cols))
+    neighbours.sort_indices()
+    return neighbours
+
+
+def normalize_rows(matrix):
+    """Return a copy of a sparse matrix with rows of unit L2 norm.
+
+    Same result as sklearn's normalize, to the last bit: the squares of each
+    row are summed in index order in float64 and the division is done in
+    float64, also for float32 data. Empty rows are left as they are.
+    """
+    matrix = sp.csr_matrix(matrix, copy=True)
+    data = matrix.data
+    row_lengths = np.diff(matrix.indptr)
+    squares = data * data
+    sums = np.zeros(matrix.shape[0])
+    # one pass per position in the rows keeps the order of the additions
+    for position in range(int(row_lengths.max()) if len(row_lengths) else 0):
+        rows = np.flatnonzero(row_lengths > position)
+        sums[rows] += squares[matrix.indptr[rows] + position]
+    norms = np.repeat(np.sqrt(sums), row_lengths)
+    nonzero = norms != 0
+    data[nonzero] = data[nonzero] / norms[nonzero]
+    return matrix
+
+
+def cosine_similarity(tf_idf_matrix, other_tf_idf_matrix):
+    """Return the dense table of cosine similarities, as sklearn's cosine_similarity
+    does for sparse matrices, without importing scikit-learn."""
+    tf_idf_matrix, other_tf_idf_matrix = sp.csr_matrix(tf_idf_matrix), sp.csr_matrix(other_tf_idf_matrix)
+    dtype = np.float32 if tf_idf_matrix.dtype == other_tf_idf_matrix.dtype == np.float32 else np.float64
+    tf_idf_matrix = normalize_rows(tf_idf_matrix.astype(dtype, copy=False))
+    other_tf_idf_matrix = normalize_rows(other_tf_idf_matrix.astype(dtype, copy=False))
+    return (tf_idf_matrix @ other_tf_idf_matrix.T).toarray()
+
+
+def get_internal_block_size(n_terms, memory_budget=INTERNAL_BLOCK_MEMORY):
+    # a block is at most block_size x n_terms scores, about 32 bytes each
+    # with their indices and the temporary arrays of the threshold
+    return max(1, memory_budget // (32 * max(n_terms, 1)))
+
+
+def get_internal_similarity_block(unit_matrix, start_idx, end_idx, threshold=0.8, top_k=None):
+    """Return rows, columns and scores of the forward neighbours of terms start_idx:end_idx.
+
+    unit_matrix has rows of unit norm (normalize_rows). Only the sparse
+    product of the block is built, never a dense block x N table, and top_k
+    is applied here, which is exact since a block holds whole rows.
+    """
+    cos_sim_block = (unit_matrix[start_idx:end_idx] @ unit_matrix.T).tocoo()
+    cond = (cos_sim_block.data > threshold) & (cos_sim_block.col > cos_sim_block.row + start_idx)
+    block_rows = cos_sim_block.row[cond].astype(np.int64) + start_idx
+    return select_top_k(block_rows, cos_sim_block.col[cond].astype(np.int64), cos_sim_block.data[cond], top_k)
+
+
+def neighbours_from_blocks(blocks, n_rows, n_cols):
+    """Join (rows, cols, scores) blocks into one csr matrix of neighbours."""
+    blocks = list(blocks)
+    if not blocks:
+        return top_k_rows(np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([]), n_rows, n_cols)
+    rows, cols, scores = (np.concatenate(parts) for parts in zip(*blocks))
+    return top_k_rows(rows, cols, scores, n_rows, n_cols)
+
+
+def get_internal_similarities(tf_idf_matrix, threshold=0.8, top_k=None, block_size=None, workers=1):
+    """Return forward neighbours of each term scoring above threshold.
+
+    Cosine similarities are computed for block_size terms at a time, by
+    default as many as fit in INTERNAL_BLOCK_MEMORY, and only entries (i, j)
+    with j > i and score > threshold are kept, at most top_k per term,
+    so memory grows with the number of neighbours rather than N x N.
+    With workers > 1 the blocks are spread over a process pool.
+    """
+    unit_matrix = normalize_rows(tf_idf_matrix)
+    n_terms = unit_matrix.shape[0]
+    if block_size is None:
+        block_size = get_internal_block_size(n_terms)
+    if workers > 1:
+        from parallel_scoring import get_internal_similarity_blocks_parallel
+        blocks = get_internal_similarity_blocks_parallel(unit_matrix, threshold, top_k, block_size, workers)
+    else:
+        blocks = (
+            get_internal_similarity_block(unit_matrix, start_idx, min(start_idx + block_size, n_terms), threshold, top_k)
+            for start_idx in range(0, n_terms, block_size)
+            )
+    return neighbours_from_blocks(blocks, n_terms, n_terms)
+
+
+def get_best_internal_matches(neighbours):
+    """Return index and score of each term's best forward duplicate.
+
+    Terms without a neighbour above the threshold get index -1 and score 0.
+    """
+    n_terms = neighbours.shape[0]
+    best_ids = np.full(n_terms, -1, dtype=np.int64)
+    best_scores = np.zeros(n_terms)
+    for i in range(n_terms):
+        row_start, row_end = neighbours.indptr[i], neighbours.indptr[i + 1]
+        if row_end > row_start:
+            idx_max_score = row_start + np.argmax(neighbours.data[row_start:row_end])  # first max, as np.argmax
+            best_ids[i] = neighbours.indices[idx_max_score]
+            best_scores[i] = neighbours.data[idx_max_score]
+    return best_ids, best_scores
+
+
+def get_internal_exact_matches(best_matches, exact_groups=None):
+    """Return whether each term's best forward duplicate is an exact one, in its own
+    exact group (see score_internal_neighbours); None without the exact pre-pass."""
+    if exact_groups is None:
+        return None
+    groups = exact_groups[0]
+    best_ids = best_matches[0]
+    return (best_ids >= 0) & (groups[np.maximum(best_ids, 0)] == groups)
+
+def find_internal_duplicates(best_matches, cutoff_sim=0.99, exact=None):
+    """Return the records of terms kept at this cutoff, with their best forward duplicate.
+
+    best_matches is the result of get_best_internal_matches and exact,
+    if given, that of get_internal_exact_matches.
+    """
+    best_ids, best_scores = best_matches
+    keep = ~((best_ids >= 0) & (best_scores > cutoff_sim))  # this removes (near-)duplicates
+
+    records = np.zeros(np.count_nonzero(keep), dtype=DUPLICATES_DTYPE)
+    records['idx'] = np.flatnonzero(keep)
+    records['master_idx'] = -1
+    records['internal_idx'] = best_ids[keep]
+    records['internal_score'] = best_scores[keep]
+    if exact is not None:
+        records['internal_exact'] = exact[keep]
+    return records
+
+def get_internal_duplicates(best_matches, cutoffs=CUTOFFS, exact=None):
     internal_duplicates_results = []
-    for cutoff_sim in [0.99, 0.9, 0.8]:
+    for cutoff_sim in cutoffs:
         results = find_internal_duplicates(
-            terms=terms,   # df['term'],
-            cos_sim_table=cos_sim_table,
-            cutoff_sim=cutoff_sim
+            best_matches=best_matches,
+            cutoff_sim=cutoff_sim,
+            exact=exact
             )
         internal_duplicates_results.append(results)
     return internal_duplicates_results
 
-def save_internal_duplicates(internal_duplicates, path):
+def cutoff_label(cutoff_sim):
+    """0.99 -> '99', 0.9 -> '90', 0.995 -> '995', 1.0 -> '100', used in the names of the output files.
+
+    Below 1 the label is every decimal of the cutoff, at least two,
+    so different cutoffs never share a file name.
+    """
+    if cutoff_sim >= 1:
+        return str(round(cutoff_sim * 100))
+    return f'{cutoff_sim:.10f}'.rstrip('0').split('.')[1].ljust(2, '0')
+
+def parse_cutoffs(text):
+    """Parse the --cutoffs option, rejecting cutoffs whose output files would overwrite each other."""
+    try:
+        cutoffs = [float(cutoff_sim) for cutoff_sim in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected comma-separated numbers, got {text!r}') from None
+    labels = [cutoff_label(cutoff_sim) for cutoff_sim in cutoffs]
+    if len(set(labels)) < len(labels):
+        raise argparse.ArgumentTypeError(f'cutoffs {text!r} give the same file names twice: {labels}')
+    return cutoffs
+
+
+def parse_export_filename(text):
+    """Check the --export_filename option when the arguments are parsed, not after the scoring."""
+    from export_reports import check_export_filename
+    try:
+        check_export_filename(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error)) from None
+    return text
+
+
+def format_internal_duplicates(records, terms):
+    """Return the lines of an 02_internal_candidate_duplicates file."""
+    lines = []
+    scores = np.round(records['internal_score'], 3).tolist()
+    for (idx, internal_idx), score in zip(records[['idx', 'internal_idx']].tolist(), scores):
+        line = f'{idx}\t{terms[idx]}'
+        if internal_idx >= 0:
+            line += f'\t{internal_idx}\t{terms[internal_idx]}\t{score}'
+        lines.append(line)
+    return lines
+
+def save_internal_duplicates(internal_duplicates, terms, path, cutoffs=CUTOFFS):
     internal_paths = [
-        '02_internal_candidate_duplicates_99_cutoff.txt',
-        '02_internal_candidate_duplicates_90_cutoff.txt',
-        '02_internal_candidate_duplicates_80_cutoff.txt'
+        f'02_internal_candidate_duplicates_{cutoff_label(cutoff_sim)}_cutoff.txt'
+        for cutoff_sim in cutoffs
         ]
 
-    for file_name, results in zip(internal_paths, internal_duplicates):
+    for file_name, records in zip(internal_paths, internal_duplicates):
         with open(os.path.join(path, file_name), 'w', encoding='utf-8') as to_f:
-            for line in results:
+            for line in format_internal_duplicates(records, terms):
                 line = line + '\n'
                 to_f.write(line)
 
@@ -108,19 +324,8 @@ def load_master_terms(master_terms_file):
     return old_terms, old_terms_cased
 
 
-def get_new_terms_lower(internal_duplicates):
-    new_terms_lower = []
-    for terms in internal_duplicates:
-        terms_temp = []
-        for line in terms:
-            # _, term = line.strip().split('\t')
-            term = line.strip().split('\t')[1]
-            terms_temp.append(term.lower())
-        new_terms_lower.append(terms_temp)
-    return new_terms_lower
-
 def compute_cosine_similarity_in_chunks(tf_idf_matrix, old_tf_idf_matrix, chunk_size=10_000):
-    n_chunks = old_tf_idf_matrix.shape[0] // chunk_size + 1
+    n_chunks = (old_tf_idf_matrix.shape[0] + chunk_size - 1) // chunk_size  # no empty last chunk
     cos_sim_table = np.zeros((tf_idf_matrix.shape[0], old_tf_idf_matrix.shape[0]))
 
     for i in range(n_chunks):
@@ -134,225 +339,577 @@ def compute_cosine_similarity_in_chunks(tf_idf_matrix, old_tf_idf_matrix, chunk_
     return cos_sim_table
 
 
-def find_duplicates_vs_master(results, cos_sim_table, old_terms_cased, cutoff_sim=0.99):
-    # get similarities vs master into a structure to write a file
+def merge_best_matches(best_ids, best_scores, ids, scores, top_k=1):
+    """Merge two top_k tables of the same terms, best first.
+
+    The stable sort keeps the first table's entry on ties, so pass
+    the matches with lower master indices first.
+    """
+    ids = np.concatenate([best_ids, ids], axis=1)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def iter_master_chunks(unit_matrix, chunk_size=10_000):
+    """Yield (start idx, transposed chunk) of a master with unit rows, as
+    compute_best_matches_in_chunks scores against them."""
+    for start_idx in range(0, unit_matrix.shape[0], chunk_size):
+        yield start_idx, unit_matrix[start_idx:start_idx + chunk_size].T.tocsr()
+
+
+def compute_best_matches_in_chunks(tf_idf_matrix, old_tf_idf_matrix, chunk_size=10_000, top_k=1,
+                                   dtype=np.float64, block_size=1_000, normalized=False, master_chunks=None):
+    """Return the top_k master indices and scores of each new term.
+
+    Unlike compute_cosine_similarity_in_chunks, no new x master table is
+    allocated: a running top_k per new term is merged with each block of
+    block_size new terms x chunk_size master terms, so memory depends on
+    those sizes and not on the size of the master list.
+    Missing matches have index -1 and score 0; ties go to the lower master
+    index, like np.argmax. With normalized, both matrices already have rows
+    of unit norm in dtype (normalize_rows). master_chunks, the list of
+    iter_master_chunks over such a master, replaces old_tf_idf_matrix; a
+    server keeps it to score many small queries without touching the master.
+    """
+    tf_idf_matrix = sp.csr_matrix(tf_idf_matrix, dtype=dtype)
+    if not normalized:
+        # once here rather than for every block, as cosine_similarity would
+        tf_idf_matrix = normalize_rows(tf_idf_matrix)
+    if master_chunks is None:
+        old_tf_idf_matrix = sp.csr_matrix(old_tf_idf_matrix, dtype=dtype)
+        if not normalized:
+            old_tf_idf_matrix = normalize_rows(old_tf_idf_matrix)
+        master_chunks = iter_master_chunks(old_tf_idf_matrix, chunk_size)
+    n_terms = tf_idf_matrix.shape[0]
+    best_ids = np.full((n_terms, top_k), -1, dtype=np.int64)
+    best_scores = np.zeros((n_terms, top_k), dtype=dtype)
+
+    for start_idx, old_chunk_transposed in master_chunks:
+        for row_start in range(0, n_terms, block_size):
+            row_end = min(row_start + block_size, n_terms)
+            cos_sim_block = (tf_idf_matrix[row_start:row_end] @ old_chunk_transposed).toarray()
+            if top_k == 1:
+                chunk_ids = np.argmax(cos_sim_block, axis=1)[:, np.newaxis]
+            else:
+                chunk_ids = np.argsort(-cos_sim_block, axis=1, kind='stable')[:, :top_k]
+            chunk_scores = np.take_along_axis(cos_sim_block, chunk_ids, axis=1)
+            chunk_ids = np.where(chunk_scores > 0, chunk_ids + start_idx, -1)
+
+            # earlier chunks go first, so the lower index is kept on ties
+            best_ids[row_start:row_end], best_scores[row_start:row_end] = merge_best_matches(
+                best_ids[row_start:row_end],
+                best_scores[row_start:row_end],
+                chunk_ids,
+                chunk_scores,
+                top_k
+                )
+
+    return best_ids, best_scores
+
+
+def get_best_master_matches(tf_idf_matrix, old_tf_idf_matrix, chunk_size=10_000, dtype=np.float64, workers=1,
+                            normalized=False, master_chunks=None):
+    """Return index and score of each new term's best match in the master list.
+
+    Terms without a master term above the threshold get index -1 and score 0.
+    With workers > 1 the master chunks are spread over a process pool.
+    normalized and master_chunks are passed on to compute_best_matches_in_chunks.
+    """
     threshold = 0.8  # below this value, (near-)duplicates are very rare
-    results_vs_master = []
-    for idx, line in enumerate(results):
-        terms = line.strip().split('\t')
-        if sum(cos_sim_table[idx] > threshold):
-            idx_max_score = np.argmax(cos_sim_table[idx])
-            max_score = round(cos_sim_table[idx][idx_max_score], 3)
-            if max_score > cutoff_sim:  # this removes (near-)duplicates
-                continue
-            terms.insert(2, old_terms_cased[idx_max_score])
-            terms.insert(3, str(max_score))
-        elif cutoff_sim != 0.8:
-            terms.insert(2, '')  # assume that some other terms have near duplicates vs master
-            terms.insert(3, '')
-        new_line = '\t'.join(terms) + '\n'
-        results_vs_master.append(new_line)
-    return results_vs_master
+    if workers > 1:
+        from parallel_scoring import compute_best_matches_parallel
+        best_ids, best_scores = compute_best_matches_parallel(
+            tf_idf_matrix,
+            old_tf_idf_matrix,
+            chunk_size=chunk_size,
+            dtype=dtype,
+            workers=workers,
+            normalized=normalized
+            )
+    else:
+        best_ids, best_scores = compute_best_matches_in_chunks(
+            tf_idf_matrix,
+            old_tf_idf_matrix,
+            chunk_size=chunk_size,
+            dtype=dtype,
+            normalized=normalized,
+            master_chunks=master_chunks
+            )
+    best_ids, best_scores = best_ids[:, 0], best_scores[:, 0]
+    has_duplicates = best_scores > threshold
+    best_ids = np.where(has_duplicates, best_ids, -1)
+    best_scores = np.where(has_duplicates, best_scores, 0)
+    return best_ids, best_scores
+
+
+def score_master_matches(tf_idf_matrix, old_tf_idf_matrix, candidates=False, dtype=np.float64, workers=1):
+    """Return best master matches, from the n-gram inverted index with candidates, else by brute force."""
+    if candidates:
+        import candidate_index
+        return candidate_index.get_best_master_candidate_matches(tf_idf_matrix, old_tf_idf_matrix)
+    return get_best_master_matches(tf_idf_matrix, old_tf_idf_matrix, dtype=dtype, workers=workers)
+
+
+def find_duplicates_vs_master(records, best_matches, cutoff_sim=0.99, exact=None):
+    """Return the records still kept at this cutoff, with their best master match.
+
+    best_matches is the result of get_best_master_matches over all terms and
+    exact, if given, tells which of them are exact master hits.
+    """
+    best_ids, best_scores = best_matches
+    master_ids = best_ids[records['idx']]
+    master_scores = best_scores[records['idx']]
+    keep = ~((master_ids >= 0) & (np.round(master_scores, 3) > cutoff_sim))  # this removes (near-)duplicates
+
+    records = records[keep]
+    records['master_idx'] = master_ids[keep]
+    records['master_score'] = master_scores[keep]
+    if exact is not None:
+        records['master_exact'] = exact[records['idx']]
+    return records
 
 
 def clean_vs_master(vs_master):
     # remove refs to ghost internal duplicates when
     # the corresponding duplicates are no longer in the list below 
     # 'cos they were deleted as 100% duplicates against the master list
-
-    # get lists of indices of terms
-    indices = []
-    for results in vs_master:
-        temp_indices = []
-        for line in results:
-            idx = line.strip().split('\t')[0]  # it's a string
-            temp_indices.append(idx)
-        indices.append(temp_indices)
-
-    # and if ref to internal duplicate is not in the list, remove it
     updated_vs_master = []
-    for i, results in enumerate(vs_master):
-         temp_results = []
-         for line in results:
-             try:
-                internal_idx = line.strip().split('\t')[4]  # it's a string
-                if internal_idx not in indices[i]:
-                    updated_line = '\t'.join(line.strip().split('\t')[:4]) + '\n'
-                    temp_results.append(updated_line)
-                else:
-                    temp_results.append(line)
-             except IndexError:
-                temp_results.append(line)
-         updated_vs_master.append(temp_results)
+    for records in vs_master:
+        records = records.copy()
+        ghosts = (records['internal_idx'] >= 0) & ~np.isin(records['internal_idx'], records['idx'])
+        records['internal_idx'][ghosts] = -1
+        records['internal_score'][ghosts] = 0
+        records['internal_exact'][ghosts] = False
+        updated_vs_master.append(records)
     return updated_vs_master
 
 
+def format_score(score, exact=False):
+    return str(score) + EXACT_MARKER if exact else str(score)
+
+
+def iter_vs_master_fields(records, terms, old_terms_cased, cutoff_sim=0.99):
+    """Yield (idx, columns) of each record, as written to the 03_ files."""
+    threshold = 0.8  # below this value, (near-)duplicates are very rare
+    master_scores = np.round(records['master_score'], 3).tolist()
+    internal_scores = np.round(records['internal_score'], 3).tolist()
+    indices = records[['idx', 'master_idx', 'internal_idx', 'master_exact', 'internal_exact']].tolist()
+    for (idx, master_idx, internal_idx, master_exact, internal_exact), master_score, internal_score in zip(
+            indices, master_scores, internal_scores):
+        fields = [str(idx), terms[idx]]
+        if master_idx >= 0:
+            fields += [old_terms_cased[master_idx], format_score(master_score, master_exact)]
+        elif cutoff_sim > threshold:
+            fields += ['', '']  # assume that some other terms have near duplicates vs master
+        if internal_idx >= 0:
+            fields += [str(internal_idx), terms[internal_idx], format_score(internal_score, internal_exact)]
+        yield idx, fields
+
+
+def format_vs_master(records, terms, old_terms_cased, cutoff_sim=0.99):
+    """Return the lines of a 03_candidate_duplicates_vs_master file."""
+    return [
+        '\t'.join(fields) + '\n'
+        for _, fields in iter_vs_master_fields(records, terms, old_terms_cased, cutoff_sim)
+        ]
+
+
 def remove_newlines(context, replace_newline='¶'):
     """Clean context by replacing newlines and tabs."""
     return re.sub(r'[\n\t]', replace_newline, context)
 
 
-def highlight_term(context, term, color='FFFF70'):
-    simpletext = re.compile("(" + re.escape(term) + ")", re.IGNORECASE)
-    replacement = f"<span style='background-color: #{color}'>\\1</span>"
-    return re.sub(simpletext, replacement, context)
+def find_term_spans(term_lower, context):
+    """Return non-overlapping (start, end) spans of a lowercased term in context, ignoring case."""
+    context_lower = to_lower(context)
+    spans = []
+    start = context_lower.find(term_lower) if term_lower else -1
+    while start != -1:
+        end = start + len(term_lower)
+        spans.append((start, end))
+        start = context_lower.find(term_lower, end)
+    return spans
 
 
-def highlight_all_terms(results_vs_master, terms_contexts_uniq, num_contexts=5):
-    """Return list of html lines with highlihted terms in their contexts."""
-    html_lines_lst = ["<table border='1'>", "<tr><th>Index</th><th>Term</th><th>Context</th></tr>"]
-    for line in results_vs_master:
-        idx = line.strip().split('\t')[0]
-        term = line.strip().split('\t')[1]
+def highlight_spans(context, spans, color='FFFF70'):
+    parts = []
+    last_end = 0
+    for start, end in spans:
+        parts.append(context[last_end:start])
+        parts.append(f"<span style='background-color: #{color}'>{context[start:end]}</span>")
+        last_end = end
+    parts.append(context[last_end:])
+    return ''.join(parts)
+
+
+HTML_TABLE_HEADER = ["<table border='1'>", "<tr><th>Index</th><th>Term</th><th>Context</th></tr>"]
+
+
+def iter_html_rows(records, terms, terms_contexts_uniq, num_contexts=5):
+    """Yield (idx, html rows) per term: the term with its first context,
+    then up to num_contexts - 1 more contexts."""
+    for idx in records['idx'].tolist():
+        term = terms[idx]
         try:
             contexts = terms_contexts_uniq[term]['contexts']  # get contexts for term
         except KeyError:
             continue
-        new_line = f'{idx}\t{term}\t'
-        context = remove_newlines(contexts[0])
+        if not contexts:
+            continue
 
-        highlighted_context = highlight_term(context, term)
-        html_lines_lst.append(f'<tr><td>{idx}</td><td>{term}</td><td>{highlighted_context}</td></tr>')
+        term_lower = to_lower(term)
+        html_rows = []
+        for context_idx, context in enumerate(contexts[:max(num_contexts, 1)]):
+            context = remove_newlines(context)
+            highlighted_context = highlight_spans(context, find_term_spans(term_lower, context))
+            if context_idx == 0:
+                html_rows.append(f'<tr><td>{idx}</td><td>{term}</td><td>{highlighted_context}</td></tr>')
+            else:
+                html_rows.append(f'<tr><td> </td><td> </td><td>{highlighted_context}</td></tr>')
+        yield idx, html_rows
 
-        new_line += f'{context}\n'
-        if num_contexts > 1 and len(contexts) > 1:
-            for context in contexts[1:num_contexts]:
-                context = remove_newlines(context)
-                new_line += f'\t\t{context}\n'
 
-                highlighted_context = highlight_term(context, term)
-                html_lines_lst.append(f'<tr><td> </td><td> </td><td>{highlighted_context}</td></tr>')
+def highlight_all_terms(records, terms, terms_contexts_uniq, num_contexts=5):
+    """Return list of html lines with highlihted terms in their contexts."""
+    html_lines_lst = list(HTML_TABLE_HEADER)
+    for _, html_rows in iter_html_rows(records, terms, terms_contexts_uniq, num_contexts):
+        html_lines_lst.extend(html_rows)
     html_lines_lst.append("</table>")
 
     return html_lines_lst
 
 
-def add_header(results_vs_master):
-    results_vs_master = results_vs_master.copy()
-    max_length = 0
-    for line in results_vs_master:
-        terms = line.strip().split('\t')
-        curr_length = len(terms)
-        if curr_length > max_length:
-            max_length = curr_length
+def write_html_report(filename, records, terms, terms_contexts_uniq, num_contexts=5, page_size=None):
+    """Write highlighted contexts to disk as they are generated.
+
+    With more than page_size terms the table is split into pages
+    <name>_001.html, <name>_002.html, ... and filename becomes an index page
+    linking to them; otherwise filename holds the whole table, as before.
+    """
+    path, base_name = os.path.split(filename)
+    stem, extension = os.path.splitext(base_name)
+    page_pattern = re.compile(re.escape(stem) + r'_\d{3,}' + re.escape(extension) + '$')
+    for old_page in os.listdir(path or '.'):
+        if page_pattern.match(old_page):  # pages left over from a bigger report
+            os.remove(os.path.join(path, old_page))
+
+    pages = []  # (file name, first idx, last idx)
+    to_f = None
+    terms_on_page = 0
+    for idx, html_rows in iter_html_rows(records, terms, terms_contexts_uniq, num_contexts):
+        if to_f is None or (page_size and terms_on_page >= page_size):
+            if to_f is not None:
+                to_f.write('</table>\n')
+                to_f.close()
+            page_name = f'{stem}_{len(pages) + 1:03d}{extension}'
+            pages.append([page_name, idx, idx])
+            to_f = open(os.path.join(path, page_name), 'w', encoding='utf-8')
+            for line in HTML_TABLE_HEADER:
+                to_f.write(f'{line}\n')
+            terms_on_page = 0
+        for line in html_rows:
+            to_f.write(f'{line}\n')
+        pages[-1][2] = idx
+        terms_on_page += 1
+
+    if to_f is not None:
+        to_f.write('</table>\n')
+        to_f.close()
+
+    if len(pages) <= 1:
+        if pages:
+            os.replace(os.path.join(path, pages[0][0]), filename)
+        else:
+            with open(filename, 'w', encoding='utf-8') as to_f:
+                for line in HTML_TABLE_HEADER + ["</table>"]:
+                    to_f.write(f'{line}\n')
+        return
+
+    with open(filename, 'w', encoding='utf-8') as to_f:
+        to_f.write(f'<h3>{stem}: {len(pages)} pages</h3>\n')
+        to_f.write('<ul>\n')
+        for page_name, first_idx, last_idx in pages:
+            to_f.write(f"<li><a href='{page_name}'>{first_idx} - {last_idx}</a></li>\n")
+        to_f.write('</ul>\n')
+
+
+def add_header(records, cutoff_sim=0.99):
+    """Return the header line for the columns used by the records."""
+    threshold = 0.8  # below this value, (near-)duplicates are very rare
+    has_master = records['master_idx'] >= 0
+    has_internal = records['internal_idx'] >= 0
+    if cutoff_sim > threshold:
+        # empty master columns only count when followed by an internal duplicate
+        has_master = has_master | has_internal
+    lengths = 2 + 2 * has_master + 3 * has_internal
+    max_length = int(lengths.max()) if len(lengths) else 0
+
     header = 'idx\tterm\tsource_file'
     if max_length > 2:
         header += '\texisting_term_WBTerm\tsim_score'
     if max_length > 5:
         header += '\tidx2\tinternal_duplicate\tsim_score'
     header += '\n'
-    results_vs_master.insert(0, header)
-    return results_vs_master
-
-
-def add_sourcename(results_with_headers, terms_contexts_uniq):
-    results_with_sourcename = []
-    results_with_sourcename.append(results_with_headers[0])  # header
-    for line in results_with_headers[1:]:  # skip header
-       line = line.strip().split('\t')
-       term = line[1]
-       line.insert(2, terms_contexts_uniq[term]['filename'])
-       updated_line = '\t'.join(line) + '\n'
-       results_with_sourcename.append(updated_line)
-    return results_with_sourcename
+    return header
+
+
+def format_duplicates(records, terms, old_terms_cased, terms_contexts_uniq, cutoff_sim=0.99):
+    """Return the lines of a duplicates_*_percent file: header, then the
+    03_ columns with the source file name after the term."""
+    lines = [add_header(records, cutoff_sim)]
+    for _, fields in iter_vs_master_fields(records, terms, old_terms_cased, cutoff_sim):
+        while fields[-1] == '':
+            fields.pop()
+        fields.insert(2, terms_contexts_uniq[fields[1]]['filename'])
+        lines.append('\t'.join(fields) + '\n')
+    return lines
+
+
+def score_internal_neighbours(tf_idf_matrix, terms_lower, args, record, cache=None):
+    """Return the forward neighbours of every term and, with --exact_prepass, the exact
+    groups (groups, representatives) of exact_duplicates.get_exact_groups, else None.
+
+    args holds the scoring options shared by find_duplicates and only_find_duplicates;
+    record, a metrics record, gets the number of terms scored and the neighbours.
+    """
+    scored_matrix = tf_idf_matrix
+    exact_groups = None
+    if args.exact_prepass:
+        # only one term per normalized key is scored
+        import exact_duplicates
+        exact_groups = exact_duplicates.get_exact_groups(terms_lower)
+        scored_matrix = tf_idf_matrix[exact_groups[1]]
+    # idf depends on all terms, so internal similarities are only reused for the same terms
+    internal_key = make_key(
+        'internal-v1', terms_lower, args.native_ngrams, args.hash_features, args.candidates, args.exact_prepass
+        )
+    cached_neighbours = cache.get(internal_key) if cache is not None else None
+    if cached_neighbours is not None:
+        neighbours = matrix_from_bytes(cached_neighbours)
+    else:
+        if args.candidates:
+            import candidate_index
+            neighbours = candidate_index.get_internal_candidate_similarities(scored_matrix)
+        else:
+            neighbours = get_internal_similarities(scored_matrix, workers=args.workers)
+        if args.exact_prepass:
+            neighbours = exact_duplicates.expand_group_neighbours(neighbours, exact_groups[0])
+        if cache is not None:
+            cache.put(internal_key, matrix_to_bytes(neighbours))
+    record['scored_terms'] = 0 if cached_neighbours is not None else scored_matrix.shape[0]
+    record['neighbours'] = matrix_info(neighbours)
+    return neighbours, exact_groups
+
+
+def score_vs_master(new_tf_idf_matrix, terms_lower, vectorizer, old_tf_idf_matrix, old_terms_cased, args, record,
+                    exact_groups=None, cache=None):
+    """Return the best master match of every term, see score_master_matches, and
+    whether it is an exact master hit, None without --exact_prepass.
+
+    With --exact_prepass, exact_groups comes from score_internal_neighbours:
+    exact master hits are resolved without scoring and only one term per
+    group is scored. Cached matches are reused; record gets the number of
+    terms scored.
+    """
+    master_exact = None
+    scored_matrix = new_tf_idf_matrix
+    scored_terms = np.arange(len(terms_lower))
+    if args.exact_prepass:
+        import exact_duplicates
+        exact_ids = exact_duplicates.get_exact_master_matches(terms_lower, old_terms_cased)
+        scored_terms = exact_duplicates.get_master_scored_terms(exact_groups[1], exact_ids)
+        scored_matrix = new_tf_idf_matrix[scored_terms]
+        record['exact_master_hits'] = int(np.count_nonzero(exact_ids >= 0))
+    dtype = np.float32 if args.float32 else np.float64
+    if cache is not None:
+        cache_misses = cache.misses
+        best_master_matches = get_cached_master_matches(
+            cache,
+            get_master_key(args.master_terms_filename, vectorizer),
+            [terms_lower[term_idx] for term_idx in scored_terms],
+            scored_matrix,
+            old_tf_idf_matrix,
+            args.candidates,
+            dtype,
+            args.workers
+            )
+        record['scored_terms'] = cache.misses - cache_misses
+    else:
+        best_master_matches = score_master_matches(
+            scored_matrix, old_tf_idf_matrix, args.candidates, dtype, args.workers
+            )
+        record['scored_terms'] = scored_matrix.shape[0]
+    if args.exact_prepass:
+        best_master_matches = exact_duplicates.expand_group_master_matches(
+            best_master_matches, scored_terms, exact_groups[0], exact_ids
+            )
+        master_exact = exact_ids >= 0
+    return best_master_matches, master_exact
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--terms_contexts_uniq_filename')
+def add_find_duplicates_arguments(parser):
+    """Add the options of find_and_report_duplicates, shared with pipeline.py."""
     parser.add_argument('--main_output_path')
     parser.add_argument('--sub_dir')
     parser.add_argument('--master_terms_filename')
     parser.add_argument('--number_contexts')
-
-    args = parser.parse_args()
-    
-    # find internal duplicates
-    terms_contexts_filename = args.terms_contexts_uniq_filename
-    terms_contexts_uniq = read_unique_terms_contexts(terms_contexts_filename)
-    terms, terms_lower = load_extracted_terms(terms_contexts_uniq)
-    tf_idf_matrix = get_internal_tf_idf_matrix(terms_lower)
-    cos_sim_table = get_internal_similarities(tf_idf_matrix)
-    internal_duplicates = get_internal_duplicates(terms, cos_sim_table)
-    save_internal_duplicates(internal_duplicates, args.sub_dir)
+    parser.add_argument('--master_index_dir')  # optional, keeps the fitted master between runs
+    parser.add_argument('--cutoffs', type=parse_cutoffs, default=','.join(str(c) for c in CUTOFFS))
+    parser.add_argument('--float32', action='store_true')  # halves scoring memory, scores may differ in the last digit
+    parser.add_argument('--candidates', action='store_true')  # score only pairs proposed by the n-gram inverted index
+    parser.add_argument('--recall_report')  # with --candidates, json file comparing them with brute force
+    parser.add_argument('--workers', type=int, default=1)  # processes scoring the brute-force path
+    parser.add_argument('--native_ngrams', action='store_true')  # vectorize with numpy instead of a Python analyzer
+    parser.add_argument('--hash_features', type=int)  # hash bigrams into this many columns, implies --native_ngrams
+    parser.add_argument('--small_input_limit', type=int, default=SMALL_INPUT_LIMIT)  # fewer terms skip scikit-learn, 0 never
+    parser.add_argument('--html_page_size', type=int, default=2000)  # terms per html page, 0 for a single page
+    parser.add_argument('--exact_prepass', action='store_true')  # resolve normalized exact duplicates without scoring
+    parser.add_argument('--clusters', action='store_true')  # also report connected groups of duplicates as clusters
+    parser.add_argument('--export_filename', type=parse_export_filename)  # all cutoffs with fixed columns, as .parquet, .arrow or .xlsx
+
+
+def find_and_report_duplicates(terms_contexts_uniq, args, metrics, cache=None):
+    """Find internal duplicates and duplicates vs master of the extracted terms and write the reports.
+
+    args holds the options of add_find_duplicates_arguments; metrics gets one
+    record per stage and cache, a StageCache or None, reuses earlier results.
+    """
+    cutoffs = args.cutoffs
+
+    with metrics.stage('vectorize_terms') as record:
+        terms, terms_lower = load_extracted_terms(terms_contexts_uniq)
+        native = uses_native_ngrams(args.native_ngrams, len(terms_lower), args.small_input_limit)
+        tf_idf_matrix = get_internal_tf_idf_matrix(terms_lower, native, args.hash_features)
+        record.update(matrix_info(tf_idf_matrix))
+
+    with metrics.stage('internal_similarities') as record:
+        neighbours, exact_groups = score_internal_neighbours(tf_idf_matrix, terms_lower, args, record, cache)
+
+    with metrics.stage('internal_duplicates'):
+        best_internal_matches = get_best_internal_matches(neighbours)
+        internal_exact = get_internal_exact_matches(best_internal_matches, exact_groups)
+        internal_duplicates = get_internal_duplicates(best_internal_matches, cutoffs, internal_exact)
+        save_internal_duplicates(internal_duplicates, terms, args.sub_dir, cutoffs)
 
     # find duplicates vs master list
-    old_terms, old_terms_cased = load_master_terms(args.master_terms_filename)
-    vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
-    old_tf_idf_matrix = vectorizer.fit_transform(old_terms)
- 
-    new_terms_lower = get_new_terms_lower(internal_duplicates)
-    # vectorize new terms - this is list of lists
-    tf_idf_matrices = []
-    for terms in new_terms_lower:
-        tf_idf_matrix = vectorizer.transform(terms)
-        tf_idf_matrices.append(tf_idf_matrix)
-
-    cos_sim_tables = []
-    for tf_idf_matrix in tf_idf_matrices:
-        cos_sim_table = compute_cosine_similarity_in_chunks(tf_idf_matrix, old_tf_idf_matrix)
-        cos_sim_tables.append(cos_sim_table)
-
-    uncleaned_vs_master = []
-    for cutoff_sim, cos_sim_table, results in zip([0.99, 0.9, 0.8], cos_sim_tables, internal_duplicates):
-        results_vs_master = find_duplicates_vs_master(
-            results=results,
-            cos_sim_table=cos_sim_table,
-            old_terms_cased=old_terms_cased,
-            cutoff_sim=cutoff_sim
+    with metrics.stage('load_master') as record:
+        from master_index import load_or_build_master_index
+        vectorizer, old_tf_idf_matrix, old_terms_cased = load_or_build_master_index(
+            args.master_terms_filename,
+            args.master_index_dir,
+            # a stored index keeps its format, it is loaded without scikit-learn anyway
+            native=native if args.master_index_dir is None else args.native_ngrams,
+            n_features=args.hash_features
             )
-        uncleaned_vs_master.append(results_vs_master)
-
-    vs_master = clean_vs_master(uncleaned_vs_master)
-
-    vs_master_paths = [
-    '03_candidate_duplicates_vs_master_99_cutoff.txt',
-    '03_candidate_duplicates_vs_master_90_cutoff.txt',
-    '03_candidate_duplicates_vs_master_80_cutoff.txt'
-    ]
-
-    for file_name, results in zip(vs_master_paths, vs_master):
-        with open(os.path.join(args.sub_dir, file_name), 'w', encoding='utf-8') as to_f:
-            for line in results:
-                to_f.write(line)
-
-    html_lines_to_write_lst = []
-
-    for lines in vs_master:
-        html_lines_to_write = highlight_all_terms(
-            lines,
-            terms_contexts_uniq,
-            int(args.number_contexts)
+        record.update(matrix_info(old_tf_idf_matrix))
+ 
+    # all cutoffs share one scoring pass over the master list
+    with metrics.stage('vectorize_terms_vs_master') as record:
+        new_tf_idf_matrix = vectorizer.transform(terms_lower)
+        record.update(matrix_info(new_tf_idf_matrix))
+
+    with metrics.stage('master_similarities') as record:
+        best_master_matches, master_exact = score_vs_master(
+            new_tf_idf_matrix, terms_lower, vectorizer, old_tf_idf_matrix, old_terms_cased, args, record,
+            exact_groups, cache
             )
-        html_lines_to_write_lst.append(html_lines_to_write)
-
-    vs_master_paths = [
-    'contexts_99_percent.html',
-    'contexts_90_percent.html',
-    'contexts_80_percent.html'
-    ]
 
-    for file_name, html_lines in zip(vs_master_paths, html_lines_to_write_lst):
-        with open(os.path.join(args.main_output_path, file_name), 'w', encoding='utf-8') as to_f:
-            for line in html_lines:
-                to_f.write(f'{line}\n')
+    if args.candidates and args.recall_report:
+        with metrics.stage('recall_report'):
+            import candidate_index
+            candidate_index.write_recall_report([
+                candidate_index.internal_recall_report(tf_idf_matrix, neighbours),
+                candidate_index.master_recall_report(new_tf_idf_matrix, old_tf_idf_matrix, best_master_matches)
+                ], args.recall_report)
+
+    with metrics.stage('duplicates_vs_master') as record:
+        uncleaned_vs_master = []
+        for cutoff_sim, records in zip(cutoffs, internal_duplicates):
+            records_vs_master = find_duplicates_vs_master(
+                records=records,
+                best_matches=best_master_matches,
+                cutoff_sim=cutoff_sim,
+                exact=master_exact
+                )
+            uncleaned_vs_master.append(records_vs_master)
+
+        vs_master = clean_vs_master(uncleaned_vs_master)
+        record['cutoffs'] = [
+            {
+                'cutoff': cutoff_sim,
+                'internal_terms': len(internal_records),
+                'terms': len(records),
+                'with_master_match': int(np.count_nonzero(records['master_idx'] >= 0)),
+                'with_internal_duplicate': int(np.count_nonzero(records['internal_idx'] >= 0))
+                }
+            for cutoff_sim, internal_records, records in zip(cutoffs, internal_duplicates, vs_master)
+            ]
+
+    if args.clusters:
+        with metrics.stage('clusters') as record:
+            import clusters
+            record['cutoffs'] = clusters.save_duplicate_clusters(
+                neighbours,
+                tf_idf_matrix,
+                new_tf_idf_matrix,
+                old_tf_idf_matrix,
+                terms,
+                old_terms_cased,
+                terms_contexts_uniq,
+                args.sub_dir,
+                args.main_output_path,
+                cutoffs
+                )
+
+    # the records are only turned into text here, once per output file
+    with metrics.stage('reports'):
+        for cutoff_sim, records in zip(cutoffs, vs_master):
+            label = cutoff_label(cutoff_sim)
+            file_name = os.path.join(args.sub_dir, f'03_candidate_duplicates_vs_master_{label}_cutoff.txt')
+            with open(file_name, 'w', encoding='utf-8') as to_f:
+                for line in format_vs_master(records, terms, old_terms_cased, cutoff_sim):
+                    to_f.write(line)
+
+            write_html_report(
+                os.path.join(args.main_output_path, f'contexts_{label}_percent.html'),
+                records,
+                terms,
+                terms_contexts_uniq,
+                int(args.number_contexts),
+                page_size=args.html_page_size
+                )
+
+            file_name = os.path.join(args.main_output_path, f'duplicates_{label}_percent.txt')
+            with open(file_name, 'w', encoding='utf-8') as to_f:
+                for line in format_duplicates(records, terms, old_terms_cased, terms_contexts_uniq, cutoff_sim):
+                    to_f.write(line)
+
+    if args.export_filename:
+        with metrics.stage('export') as record:
+            from export_reports import export_duplicates
+            record['rows'] = export_duplicates(
+                args.export_filename, vs_master, cutoffs, terms, old_terms_cased, terms_contexts_uniq
+                )
 
-    results_with_headers = []
-    for results in vs_master:
-        results_with_headers.append(add_header(results))
 
-    results_with_sourcename = []
-    for results in results_with_headers:
-        results_with_sourcename.append(add_sourcename(results, terms_contexts_uniq))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--terms_contexts_uniq_filename')
+    add_find_duplicates_arguments(parser)
+    parser.add_argument('--metrics_out')  # jsonl file of per-stage time, memory, matrix sizes and term counts
+    parser.add_argument('--cache_dir')  # reuse similarities of unchanged terms from earlier runs
 
+    args = parser.parse_args()
+    metrics = Metrics('find_duplicates')
+    cache = open_cache(args.cache_dir)
+    
+    with metrics.stage('load_terms') as record:
+        terms_contexts_uniq = read_unique_terms_contexts(args.terms_contexts_uniq_filename)
+        record['terms'] = len(terms_contexts_uniq)
 
-    vs_master_paths_header = [
-    'duplicates_99_percent.txt',
-    'duplicates_90_percent.txt',
-    'duplicates_80_percent.txt'
-    ]
+    find_and_report_duplicates(terms_contexts_uniq, args, metrics, cache)
 
-    for file_name, results in zip(vs_master_paths_header, results_with_sourcename):
-        with open(os.path.join(args.main_output_path, file_name), 'w', encoding='utf-8') as to_f:
-            for line in results:
-                to_f.write(line)
+    if cache is not None:
+        cache.close()
+    metrics.write(args.metrics_out)
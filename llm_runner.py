@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import urllib.error
+import urllib.request
+
+from preprocess import is_jsonl
+from preprocess import iter_jsonl
+from preprocess import write_jsonl
+
+
+# errors worth retrying: rate limits, server overload and gateway errors
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Let through at most tokens_per_minute estimated tokens per minute, refilled continuously."""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.tokens = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.capacity)  # a request larger than a minute's budget waits for a full bucket
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+def estimate_tokens(prompt_dict, max_tokens):
+    # about four characters per token for the prompt, plus the longest allowed answer
+    return (len(prompt_dict['prompt']) + len(prompt_dict['text'])) // 4 + max_tokens
+
+
+def build_messages(prompt_dict):
+    return [{'role': 'user', 'content': prompt_dict['prompt'] + '\n\n' + prompt_dict['text']}]
+
+
+def hash_prompt(prompt_dict):
+    # saved with each response: adding a source file shifts the indices of the later requests
+    return hashlib.sha256(build_messages(prompt_dict)[0]['content'].encode('utf-8')).hexdigest()
+
+
+def post_chat_completion(url, api_key, body, timeout):
+    """Send one chat completion request and return the answer text; blocking, run in a thread."""
+    headers = {'Content-Type': 'application/json'}
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'), headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)['choices'][0]['message']['content']
+
+
+def get_retry_delay(attempt, error, backoff=1.0, max_delay=60.0):
+    """Exponential backoff with jitter, or the server's Retry-After when it sends one."""
+    retry_after = getattr(error, 'headers', None) and error.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(max_delay, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def is_retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRY_STATUSES
+    return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError))
+
+
+async def get_response(index, prompt_dict, settings, bucket):
+    """Return the LLM answer to one prompt, retrying transient errors with backoff."""
+    body = {
+        'model': settings['model'],
+        'messages': build_messages(prompt_dict),
+        'temperature': 0,
+        'max_tokens': settings['max_tokens']
+        }
+    for attempt in range(settings['max_retries'] + 1):
+        await bucket.acquire(estimate_tokens(prompt_dict, settings['max_tokens']))
+        try:
+            return await asyncio.to_thread(
+                post_chat_completion, settings['url'], settings['api_key'], body, settings['timeout']
+                )
+        except Exception as error:  # noqa: BLE001 - anything not retryable is raised below
+            if not is_retryable(error) or attempt == settings['max_retries']:
+                raise RuntimeError(f'request {index} failed after {attempt + 1} attempts: {error}') from error
+            await asyncio.sleep(get_retry_delay(attempt, error, settings['backoff']))
+
+
+def trim_checkpoint(checkpoint_filename):
+    """Cut a last line left incomplete by a crash, so appended responses start on a line of their own."""
+    if not os.path.exists(checkpoint_filename):
+        return
+    with open(checkpoint_filename, 'rb+') as checkpoint_f:
+        data = checkpoint_f.read()
+        if data and not data.endswith(b'\n'):
+            checkpoint_f.truncate(data.rfind(b'\n') + 1)
+
+
+def read_checkpoint(checkpoint_filename):
+    """Return {request index: (prompt hash, response)} saved by earlier runs.
+
+    A line cut off by a crash is ignored, so its request is simply sent again.
+    When an index was answered twice, the later line wins.
+    """
+    done = {}
+    if not os.path.exists(checkpoint_filename):
+        return done
+    with open(checkpoint_filename, 'r', encoding='utf-8') as from_f:
+        for line in from_f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done[record['index']] = (record.get('hash'), record['response'])
+    return done
+
+
+async def run_requests(requests_filename, checkpoint_filename, settings, max_in_flight=8, tokens_per_minute=90_000):
+    """Send every request not in the checkpoint yet and append each response to it as it arrives.
+
+    A saved response only counts for the same prompt and text, so requests
+    that moved to another index are sent again. requests_filename is streamed; at most max_in_flight requests are waiting
+    for an answer at any time. Returns the number of requests in the file.
+    """
+    trim_checkpoint(checkpoint_filename)
+    done = read_checkpoint(checkpoint_filename)
+    bucket = TokenBucket(tokens_per_minute)
+    in_flight = asyncio.Semaphore(max_in_flight)
+    pending = set()
+
+    with open(checkpoint_filename, 'a', encoding='utf-8') as checkpoint_f:
+        async def send(index, prompt_dict, prompt_hash):
+            try:
+                response = await get_response(index, prompt_dict, settings, bucket)
+            finally:
+                in_flight.release()
+            # one complete line per response, so a crash loses at most the requests in flight
+            record = {'index': index, 'hash': prompt_hash, 'response': response}
+            checkpoint_f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            checkpoint_f.flush()
+
+        n_requests = 0
+        try:
+            for index, prompt_dict in enumerate(iter_jsonl(requests_filename)):
+                n_requests += 1
+                prompt_hash = hash_prompt(prompt_dict)
+                if index in done and done[index][0] == prompt_hash:
+                    continue
+                await in_flight.acquire()
+                for task in [task for task in pending if task.done()]:
+                    pending.discard(task)
+                    task.result()  # stops the run on a request that failed for good
+                pending.add(asyncio.create_task(send(index, prompt_dict, prompt_hash)))
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+    return n_requests
+
+
+def write_responses(checkpoint_filename, n_requests, responses_filename):
+    """Write the responses in request order, as postprocess.read_responses reads them."""
+    done = read_checkpoint(checkpoint_filename)
+    missing = [index for index in range(n_requests) if index not in done]
+    if missing:
+        raise RuntimeError(f'{len(missing)} requests have no response yet, first {missing[0]}')
+    responses = (done[index][1] for index in range(n_requests))
+    if is_jsonl(responses_filename):
+        write_jsonl(responses, responses_filename)
+        return
+    with open(responses_filename, 'w', encoding='utf-8') as to_f:
+        json.dump(list(responses), to_f, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests_filename')
+    parser.add_argument('--responses_filename')
+    parser.add_argument('--checkpoint_filename')  # default: responses filename + .checkpoint.jsonl
+    parser.add_argument('--base_url', default='https://api.openai.com/v1')  # any OpenAI-compatible endpoint
+    parser.add_argument('--model')
+    parser.add_argument('--api_key_env', default='OPENAI_API_KEY')  # environment variable holding the key
+    parser.add_argument('--max_in_flight', type=int, default=8)  # requests waiting for an answer at once
+    parser.add_argument('--tokens_per_minute', type=int, default=90_000)  # estimated prompt + answer tokens
+    parser.add_argument('--max_tokens', type=int, default=1_000)  # longest answer allowed per request
+    parser.add_argument('--max_retries', type=int, default=6)
+    parser.add_argument('--backoff', type=float, default=1.0)  # seconds before the first retry, doubled each time
+    parser.add_argument('--timeout', type=float, default=120.0)  # seconds per request
+    args = parser.parse_args()
+
+    checkpoint_filename = args.checkpoint_filename or args.responses_filename + '.checkpoint.jsonl'
+    settings = {
+        'url': args.base_url.rstrip('/') + '/chat/completions',
+        'api_key': os.environ.get(args.api_key_env),
+        'model': args.model,
+        'max_tokens': args.max_tokens,
+        'max_retries': args.max_retries,
+        'backoff': args.backoff,
+        'timeout': args.timeout
+        }
+    n_requests = asyncio.run(run_requests(
+        args.requests_filename, checkpoint_filename, settings, args.max_in_flight, args.tokens_per_minute
+        ))
+    write_responses(checkpoint_filename, n_requests, args.responses_filename)
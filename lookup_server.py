@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import numpy as np
+import scipy.sparse as sp
+
+from find_duplicates import get_best_master_matches
+from find_duplicates import iter_master_chunks
+from find_duplicates import normalize_rows
+from master_index import load_or_build_master_index
+
+
+DEFAULT_PORT = 8765
+
+
+def get_file_state(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ResidentMaster:
+    """The master index of the lookup server, reloaded when the master file changes.
+
+    A query scores against the snapshot current when it started, so a reload
+    triggered by another request never changes the index under it. Everything
+    a query needs of the master, its normalized and transposed chunks or
+    with candidates its prefix index, is built once per snapshot, so a query
+    only costs the scoring of its own terms.
+    """
+
+    def __init__(self, master_terms_filename, index_dir=None, native=False, n_features=None,
+                 candidates=False, dtype=np.float64):
+        self.master_terms_filename = master_terms_filename
+        self.index_dir = index_dir
+        self.native = native
+        self.n_features = n_features
+        self.candidates = candidates
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.get_snapshot()
+
+    def load(self, file_state):
+        start = time.perf_counter()
+        vectorizer, old_tf_idf_matrix, old_terms_cased = load_or_build_master_index(
+            self.master_terms_filename,
+            self.index_dir,
+            native=self.native,
+            n_features=self.n_features
+            )
+        snapshot = {
+            'vectorizer': vectorizer,
+            'lines': old_terms_cased,
+            'file_state': file_state
+            }
+        if self.candidates:
+            import candidate_index
+            snapshot['prefix_index'] = candidate_index.get_master_prefix_index(old_tf_idf_matrix)
+        else:
+            unit_matrix = normalize_rows(sp.csr_matrix(old_tf_idf_matrix, dtype=self.dtype))
+            snapshot['master_chunks'] = list(iter_master_chunks(unit_matrix))
+        snapshot['load_time'] = time.perf_counter() - start
+        self.snapshot = snapshot
+
+    def get_snapshot(self):
+        """Return the current index, reloading it first if the master file has changed."""
+        try:
+            file_state = get_file_state(self.master_terms_filename)
+            if self.snapshot is None or self.snapshot['file_state'] != file_state:
+                with self.lock:
+                    # another request may have reloaded it while this one waited
+                    if self.snapshot is None or self.snapshot['file_state'] != file_state:
+                        self.load(file_state)
+        except OSError:
+            # the master file is being replaced: answer from the loaded index, a later request reloads it
+            if self.snapshot is None:
+                raise
+        return self.snapshot
+
+    def match(self, terms):
+        """Return the best master line and score of each term, None and 0 if nothing is above the threshold."""
+        snapshot = self.get_snapshot()
+        if not terms:
+            return []
+        terms_lower = [term.split('|')[0].strip().lower() for term in terms]  # as load_master_terms
+        tf_idf_matrix = snapshot['vectorizer'].transform(terms_lower)
+        if self.candidates:
+            import candidate_index
+            best_ids, best_scores = candidate_index.get_best_master_candidate_matches(
+                tf_idf_matrix, None, master_prefix_index=snapshot['prefix_index']
+                )
+        else:
+            best_ids, best_scores = get_best_master_matches(
+                tf_idf_matrix, None, dtype=self.dtype, master_chunks=snapshot['master_chunks']
+                )
+        return [
+            {
+                'term': term,
+                'master': snapshot['lines'][best_id] if best_id >= 0 else None,
+                'score': score
+                }
+            for term, best_id, score in zip(terms, best_ids.tolist(), np.round(best_scores, 3).tolist())
+            ]
+
+    def status(self):
+        snapshot = self.snapshot
+        return {
+            'master_terms_filename': self.master_terms_filename,
+            'master_terms': len(snapshot['lines']),
+            'load_time': snapshot['load_time']
+            }
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    """POST /match with {"terms": [...]} returns {"matches": [...]}; GET /status describes the index."""
+
+    master = None  # set on the class by serve()
+
+    def send_json(self, status, value):
+        body = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        self.send_json(200, self.master.status())
+
+    def do_POST(self):
+        if self.path != '/match':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            terms = query['terms']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'expected a JSON body {"terms": [...]}'})
+            return
+        if not isinstance(terms, list) or not all(isinstance(term, str) for term in terms):
+            self.send_json(400, {'error': '"terms" must be a list of strings'})
+            return
+        start = time.perf_counter()
+        matches = self.master.match(terms)
+        self.send_json(200, {'matches': matches, 'time': time.perf_counter() - start})
+
+    def log_message(self, format, *args):
+        pass  # keep the terminal quiet, one line per query is too much for batch clients
+
+
+class LookupServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # batch clients open many connections at once
+
+
+def serve(master, host='127.0.0.1', port=DEFAULT_PORT):
+    """Answer queries against master until interrupted, one thread per request."""
+    LookupHandler.master = master
+    server = LookupServer((host, port), LookupHandler)
+    print(f"{master.status()['master_terms']} master terms loaded, listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def query_server(terms, url=f'http://127.0.0.1:{DEFAULT_PORT}'):
+    """Return the matches of terms from a running lookup server."""
+    request = urllib.request.Request(
+        url.rstrip('/') + '/match',
+        data=json.dumps({'terms': terms}, ensure_ascii=False).encode('utf-8'),
+        headers={'Content-Type': 'application/json; charset=utf-8'}
+        )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)['matches']
+
+
+if __name__ == '__main__':
+    # serve:  lookup_server.py --master_terms_filename master.txt
+    # query:  lookup_server.py --query_terms_filename terms.txt
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--master_terms_filename')
+    parser.add_argument('--master_index_dir')  # optional, reloads after appended lines only vectorize those
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--float32', action='store_true')  # halves scoring memory, scores may differ in the last digit
+    parser.add_argument('--candidates', action='store_true')  # score only pairs proposed by the n-gram inverted index
+    parser.add_argument('--native_ngrams', action='store_true')  # vectorize with numpy instead of a Python analyzer
+    parser.add_argument('--hash_features', type=int)  # hash bigrams into this many columns, implies --native_ngrams
+    parser.add_argument('--query_terms_filename')  # instead of serving, look up these terms in a running server
+    args = parser.parse_args()
+
+    if args.query_terms_filename:
+        with open(args.query_terms_filename, 'r', encoding='utf-8') as from_f:
+            terms = [line.strip() for line in from_f if line.strip()]
+        for match in query_server(terms, f'http://{args.host}:{args.port}'):
+            print('\t'.join([match['term'], match['master'] or '', str(match['score']) if match['master'] else '']))
+    else:
+        serve(
+            ResidentMaster(
+                args.master_terms_filename,
+                args.master_index_dir,
+                native=args.native_ngrams,
+                n_features=args.hash_features,
+                candidates=args.candidates,
+                dtype=np.float32 if args.float32 else np.float64
+                ),
+            args.host,
+            args.port
+            )
@@ -0,0 +1,252 @@
+import os
+import argparse
+import hashlib
+import io
+import json
+import re
+import numpy as np
+import scipy.sparse as sp
+
+from bigram_vectorizer import BigramVectorizer
+from find_duplicates import load_master_terms
+from find_duplicates import ngrams
+from find_duplicates import make_vectorizer
+from term_store import write_term_store
+from term_store import open_term_store
+from term_store import remove_term_store
+from term_store import term_store_exists
+
+
+META_FILENAME = 'meta.json'
+VOCABULARY_FILENAME = 'vocabulary.json'
+BIGRAMS_FILENAME = 'bigrams.npy'
+IDF_FILENAME = 'idf.npy'
+MATRIX_FILENAME = 'matrix.npz'
+# lines_<generation>.bin and lines_<generation>_offsets.npy, see term_store
+LINES_STORE_PATTERN = re.compile(r'^(lines(?:_(\d+))?)\.bin$')
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_master_bytes(master_terms_filename):
+    with open(master_terms_filename, 'rb') as from_f:
+        return from_f.read()
+
+
+def parse_master_lines(text):
+    """Same parsing as load_master_terms, but on a decoded string."""
+    old_terms = []
+    old_terms_cased = []
+    for line in io.StringIO(text, newline=None):
+        line = line.strip()
+        if line:
+            term = line.split('|')[0].strip()
+            old_terms.append(term.lower().strip())
+            old_terms_cased.append(line)
+    return old_terms, old_terms_cased
+
+
+def get_vectorizer_settings(native=False, n_features=None):
+    """Describe the vectorizer of an index; an index built with other settings is rebuilt."""
+    return {'native': bool(native or n_features is not None), 'n_features': n_features}
+
+
+def build_master_index(master_terms_filename, native=False, n_features=None):
+    old_terms, old_terms_cased = load_master_terms(master_terms_filename)
+    vectorizer = make_vectorizer(native, n_features)
+    old_tf_idf_matrix = vectorizer.fit_transform(old_terms)
+    return vectorizer, old_tf_idf_matrix, old_terms_cased
+
+
+def get_lines_stores(index_dir):
+    """Return {store name: generation} of the lines stores in index_dir."""
+    stores = {}
+    for filename in os.listdir(index_dir):
+        match = LINES_STORE_PATTERN.match(filename)
+        if match:
+            stores[match.group(1)] = int(match.group(2) or 0)
+    return stores
+
+
+def save_master_index(index_dir, vectorizer, old_tf_idf_matrix, old_terms_cased, master_bytes,
+                      native=False, n_features=None):
+    os.makedirs(index_dir, exist_ok=True)
+    # without meta the files below are never trusted, so an interrupted
+    # save leaves an index that is rebuilt instead of one that is half new
+    meta_path = os.path.join(index_dir, META_FILENAME)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    # the settings and not the vectorizer's class decide the format, as a
+    # TfidfVectorizer index is loaded into a BigramVectorizer
+    settings = get_vectorizer_settings(native, n_features)
+    if not settings['native']:
+        vocabulary = [None] * len(vectorizer.vocabulary_)
+        for ngram, column in vectorizer.vocabulary_.items():
+            vocabulary[column] = ngram
+        with open(os.path.join(index_dir, VOCABULARY_FILENAME), 'w', encoding='utf-8') as to_f:
+            json.dump(vocabulary, to_f, ensure_ascii=False)
+    elif settings['n_features'] is None:
+        np.save(os.path.join(index_dir, BIGRAMS_FILENAME), vectorizer.bigrams_)
+    np.save(os.path.join(index_dir, IDF_FILENAME), vectorizer.idf_)
+    sp.save_npz(os.path.join(index_dir, MATRIX_FILENAME), sp.csr_matrix(old_tf_idf_matrix), compressed=False)
+    # the lines go to a new store, as readers may still have the current one mapped
+    old_stores = get_lines_stores(index_dir)
+    lines_store = f'lines_{max(old_stores.values(), default=0) + 1}'
+    write_term_store(old_terms_cased, index_dir, lines_store)
+
+    # meta is written last and renamed into place, so it only ever describes complete files
+    meta = {
+        'master_sha256': hash_bytes(master_bytes),
+        'master_size': len(master_bytes),
+        'n_terms': len(old_terms_cased),
+        'vectorizer': settings,
+        'lines_store': lines_store
+        }
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as to_f:
+        json.dump(meta, to_f)
+    os.replace(meta_path + '.tmp', meta_path)
+    for name in old_stores:
+        remove_term_store(index_dir, name)
+
+
+def read_master_index_meta(index_dir):
+    try:
+        with open(os.path.join(index_dir, META_FILENAME), 'r', encoding='utf-8') as from_f:
+            meta = json.load(from_f)
+    except (OSError, ValueError):
+        return None
+    # indexes from before the term store generations have no lines_store and are rebuilt
+    if 'lines_store' not in meta or not term_store_exists(index_dir, meta['lines_store']):
+        return None
+    return meta
+
+
+def load_master_index(index_dir, lines_store, native=False, n_features=None):
+    idf = np.load(os.path.join(index_dir, IDF_FILENAME))
+    if not native and n_features is None:
+        with open(os.path.join(index_dir, VOCABULARY_FILENAME), 'r', encoding='utf-8') as from_f:
+            vocabulary = json.load(from_f)
+        # same matrices as the TfidfVectorizer, without importing scikit-learn
+        vectorizer = BigramVectorizer.from_vocabulary(vocabulary, idf)
+        if vectorizer is None:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            vectorizer = TfidfVectorizer(
+                min_df=1,
+                analyzer=ngrams,
+                vocabulary={ngram: column for column, ngram in enumerate(vocabulary)}
+                )
+            vectorizer.idf_ = idf
+    else:
+        vectorizer = make_vectorizer(native, n_features)
+        if n_features is None:
+            vectorizer.bigrams_ = np.load(os.path.join(index_dir, BIGRAMS_FILENAME))
+        vectorizer.idf_ = idf
+    old_tf_idf_matrix = sp.load_npz(os.path.join(index_dir, MATRIX_FILENAME)).tocsr()
+    # a memory-mapped TermStore, indexed by master idx like the list of lines
+    old_terms_cased = open_term_store(index_dir, lines_store)
+    return vectorizer, old_tf_idf_matrix, old_terms_cased
+
+
+def append_master_terms(vectorizer, old_tf_idf_matrix, old_terms_cased, new_terms, new_terms_cased):
+    """Add rows for newly approved terms without refitting.
+
+    The new rows are weighted with the stored vocabulary and IDF, so bigrams
+    never seen in the master are ignored, exactly as for new terms that are
+    checked against it. Rebuild the index to refresh the weights.
+    """
+    if not new_terms:
+        return old_tf_idf_matrix, old_terms_cased
+    new_tf_idf_matrix = vectorizer.transform(new_terms)
+    old_tf_idf_matrix = sp.vstack([old_tf_idf_matrix, new_tf_idf_matrix], format='csr')
+    return old_tf_idf_matrix, list(old_terms_cased) + new_terms_cased
+
+
+def load_or_build_master_index(master_terms_filename, index_dir=None, rebuild=False, native=False, n_features=None):
+    """Return vectorizer, tf-idf matrix and cased lines of the master list.
+
+    Without index_dir this simply fits a new vectorizer on the master file.
+    With index_dir the stored index is used while the master file's hash
+    matches; if the file only had lines appended, just those lines are added,
+    otherwise the index is rebuilt. native and n_features select the
+    vectorizer, see make_vectorizer; an index built with another one is rebuilt.
+    """
+    if index_dir is None:
+        return build_master_index(master_terms_filename, native, n_features)
+
+    master_bytes = read_master_bytes(master_terms_filename)
+    meta = None if rebuild else read_master_index_meta(index_dir)
+    # indexes saved before the vectorizer was recorded used TfidfVectorizer
+    if meta is not None and meta.get('vectorizer', get_vectorizer_settings()) != get_vectorizer_settings(native, n_features):
+        meta = None
+
+    if meta is not None and meta['master_sha256'] == hash_bytes(master_bytes):
+        return load_master_index(index_dir, meta['lines_store'], native, n_features)
+
+    if meta is not None:
+        prefix_size = meta['master_size']
+        prefix = master_bytes[:prefix_size]
+        appended_only = (
+            len(master_bytes) > prefix_size
+            and (prefix_size == 0 or prefix.endswith(b'\n'))
+            and hash_bytes(prefix) == meta['master_sha256']
+            )
+        if appended_only:
+            vectorizer, old_tf_idf_matrix, old_terms_cased = load_master_index(
+                index_dir, meta['lines_store'], native, n_features
+                )
+            new_terms, new_terms_cased = parse_master_lines(master_bytes[prefix_size:].decode('utf-8'))
+            old_tf_idf_matrix, old_terms_cased = append_master_terms(
+                vectorizer, old_tf_idf_matrix, old_terms_cased, new_terms, new_terms_cased
+                )
+            save_master_index(
+                index_dir, vectorizer, old_tf_idf_matrix, old_terms_cased, master_bytes, native, n_features
+                )
+            return vectorizer, old_tf_idf_matrix, old_terms_cased
+
+    vectorizer, old_tf_idf_matrix, old_terms_cased = build_master_index(master_terms_filename, native, n_features)
+    save_master_index(index_dir, vectorizer, old_tf_idf_matrix, old_terms_cased, master_bytes, native, n_features)
+    return vectorizer, old_tf_idf_matrix, old_terms_cased
+
+
+def append_to_master_file(master_terms_filename, new_terms_filename):
+    with open(new_terms_filename, 'r', encoding='utf-8') as from_f:
+        new_lines = [line.strip() for line in from_f if line.strip()]
+    master_bytes = read_master_bytes(master_terms_filename)
+    with open(master_terms_filename, 'a', encoding='utf-8') as to_f:
+        if master_bytes and not master_bytes.endswith(b'\n'):
+            to_f.write('\n')
+        for line in new_lines:
+            to_f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--master_terms_filename')
+    parser.add_argument('--master_index_dir')
+    parser.add_argument('--append_terms_filename')
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--native_ngrams', action='store_true')  # vectorize with numpy instead of a Python analyzer
+    parser.add_argument('--hash_features', type=int)  # hash bigrams into this many columns, implies --native_ngrams
+    args = parser.parse_args()
+
+    if args.append_terms_filename:
+        # make sure the index matches the file before it grows,
+        # so that only the appended lines are vectorized
+        load_or_build_master_index(
+            args.master_terms_filename,
+            args.master_index_dir,
+            args.rebuild,
+            args.native_ngrams,
+            args.hash_features
+            )
+        append_to_master_file(args.master_terms_filename, args.append_terms_filename)
+    _, old_tf_idf_matrix, _ = load_or_build_master_index(
+        args.master_terms_filename,
+        args.master_index_dir,
+        rebuild=args.rebuild and not args.append_terms_filename,
+        native=args.native_ngrams,
+        n_features=args.hash_features
+        )
+    print(f'{old_tf_idf_matrix.shape[0]} master terms indexed in {args.master_index_dir}')
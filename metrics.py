@@ -0,0 +1,184 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows, see get_windows_memory_counters
+    resource = None
+
+# seconds between two RSS samples where the kernel's peak cannot be reset
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def get_windows_memory_counters():
+    """Return (current, peak) working set of this process in bytes, on Windows."""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage'
+                )
+            ]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    ctypes.windll.psapi.GetProcessMemoryInfo(
+        ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+        )
+    return counters.WorkingSetSize, counters.PeakWorkingSetSize
+
+
+def get_peak_rss():
+    """Return the peak RSS in bytes of this process and of its finished children,
+    over the whole run; children are only known where resource is."""
+    if resource is None:
+        if sys.platform == 'win32':
+            return get_windows_memory_counters()[1], None
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        )
+
+
+def get_current_rss():
+    """Return the RSS in bytes of this process now, None where it is not known."""
+    if sys.platform == 'win32':
+        return get_windows_memory_counters()[0]
+    try:
+        with open('/proc/self/statm', 'r') as from_f:
+            return int(from_f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_kernel_peak_rss():
+    """Reset the Linux peak RSS of this process (VmHWM) to its current RSS; False if not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as to_f:
+            to_f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def read_kernel_peak_rss():
+    with open('/proc/self/status', 'r') as from_f:
+        for line in from_f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+class StagePeakRSS:
+    """Measure the peak RSS of this process during one stage.
+
+    On Linux the kernel's own peak is reset when the stage starts and read
+    when it ends. Elsewhere, Windows included, a thread samples the current
+    RSS every RSS_SAMPLE_INTERVAL seconds, which can miss a very short peak.
+    """
+
+    def __init__(self):
+        self.peak = None
+        self.done = threading.Event()
+        self.sampler = None
+        if not reset_kernel_peak_rss():
+            self.peak = get_current_rss()
+            if self.peak is not None:
+                self.sampler = threading.Thread(target=self.sample, daemon=True)
+                self.sampler.start()
+
+    def sample(self):
+        while not self.done.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, get_current_rss())
+
+    def stop(self):
+        if self.sampler is None:
+            return read_kernel_peak_rss() if self.peak is None else self.peak
+        self.done.set()
+        self.sampler.join()
+        return max(self.peak, get_current_rss())
+
+
+def get_cpu_time():
+    """Return CPU seconds used by this process and its finished children, such as pool workers."""
+    if resource is None:
+        return time.process_time()
+    cpu_time = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu_time += usage.ru_utime + usage.ru_stime
+    return cpu_time
+
+
+def matrix_info(matrix):
+    return {'shape': list(matrix.shape), 'nnz': int(matrix.nnz)}
+
+
+def counted(items, record, key):
+    """Yield items while counting them in record[key], for streamed stages."""
+    record[key] = 0
+    for item in items:
+        record[key] += 1
+        yield item
+
+
+class Metrics:
+    """Collect per-stage wall time, CPU time and peak RSS of a script run.
+
+    Each stage becomes one JSON line of the metrics file, with any extra
+    values (matrix shapes, term counts) added to the dict it yields.
+    peak_rss is the peak of this process during the stage (StagePeakRSS);
+    children_peak_rss is the largest finished child process, such as a pool
+    worker, if one of this stage raised it, else None. The 'total' line has
+    the peaks of the whole run.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.records = []
+        self.start_wall_time = time.perf_counter()
+        self.start_cpu_time = get_cpu_time()
+
+    @contextmanager
+    def stage(self, name, **values):
+        record = {'script': self.script, 'stage': name}
+        record.update(values)
+        start_children_peak_rss = get_peak_rss()[1]
+        peak_rss = StagePeakRSS()
+        start_wall_time, start_cpu_time = time.perf_counter(), get_cpu_time()
+        yield record
+        record['wall_time'] = time.perf_counter() - start_wall_time
+        record['cpu_time'] = get_cpu_time() - start_cpu_time
+        record['peak_rss'] = peak_rss.stop()
+        children_peak_rss = get_peak_rss()[1]
+        record['children_peak_rss'] = children_peak_rss if children_peak_rss != start_children_peak_rss else None
+        self.records.append(record)
+
+    def write(self, filename):
+        """Write the stages and a 'total' line as JSONL; nothing without filename."""
+        if not filename:
+            return
+        total = {
+            'script': self.script,
+            'stage': 'total',
+            'wall_time': time.perf_counter() - self.start_wall_time,
+            'cpu_time': get_cpu_time() - self.start_cpu_time
+            }
+        total['peak_rss'], total['children_peak_rss'] = get_peak_rss()
+        # resetting VmHWM also resets ru_maxrss, so the stages' peaks count too
+        stage_peaks = [record['peak_rss'] for record in self.records if record['peak_rss'] is not None]
+        if total['peak_rss'] is not None and stage_peaks:
+            total['peak_rss'] = max(total['peak_rss'], *stage_peaks)
+        with open(filename, 'w', encoding='utf-8') as to_f:
+            for record in self.records + [total]:
+                to_f.write(json.dumps(record) + '\n')
@@ -0,0 +1,86 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+def extract_mock_terms(text, max_terms=10):
+    """Answer like the LLM does: one candidate term per line, here the longest words of the segment."""
+    words = dict.fromkeys(word for word in re.findall(r'[^\W\d_]{4,}', text))
+    return '\n'.join(sorted(words, key=len, reverse=True)[:max_terms])
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """Answer POST .../chat/completions like an OpenAI-compatible endpoint.
+
+    With server.fail_rate some requests get a 429 instead, to exercise retries.
+    """
+
+    def send_json(self, status, value, headers=None):
+        body = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, header in (headers or {}).items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        server = self.server
+        with server.lock:
+            server.n_requests += 1
+            fail = server.random.random() < server.fail_rate
+        if fail:
+            self.send_json(429, {'error': {'message': 'rate limited'}}, {'Retry-After': '0.1'})
+            return
+        time.sleep(server.delay)
+        content = extract_mock_terms(body['messages'][-1]['content'].split('\n\n', 1)[-1])
+        self.send_json(200, {
+            'object': 'chat.completion',
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}]
+            })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_mock_server(host='127.0.0.1', port=0, fail_rate=0.0, delay=0.0, seed=0):
+    """Return a mock LLM server; port 0 picks a free port, see server.server_address."""
+    server = ThreadingHTTPServer((host, port), MockLLMHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.random = random.Random(seed)
+    server.fail_rate = fail_rate
+    server.delay = delay
+    server.n_requests = 0
+    return server
+
+
+if __name__ == '__main__':
+    # llm_runner.py --base_url http://127.0.0.1:8766/v1 runs against this server
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--fail_rate', type=float, default=0.0)  # share of requests answered with 429
+    parser.add_argument('--delay', type=float, default=0.0)  # seconds before each answer
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = make_mock_server(args.host, args.port, args.fail_rate, args.delay, args.seed)
+    print(f'mock LLM listening on http://{args.host}:{server.server_address[1]}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,13 +1,21 @@
 import argparse
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
 
 from find_duplicates import load_master_terms
 from find_duplicates import get_internal_tf_idf_matrix
-from find_duplicates import get_internal_similarities
+from find_duplicates import score_internal_neighbours
+from find_duplicates import get_best_internal_matches
+from find_duplicates import get_internal_exact_matches
 from find_duplicates import find_internal_duplicates
-from find_duplicates import ngrams
-from find_duplicates import compute_cosine_similarity_in_chunks
+from find_duplicates import score_vs_master
 from find_duplicates import find_duplicates_vs_master
+from find_duplicates import format_vs_master
+from find_duplicates import uses_native_ngrams
+from find_duplicates import SMALL_INPUT_LIMIT
+from master_index import load_or_build_master_index
+from metrics import Metrics
+from metrics import matrix_info
+from stage_cache import open_cache
 
 
 def write_file(filepath, vs_master):
@@ -21,34 +29,77 @@ if __name__ == '__main__':
     parser.add_argument('--new_terms_filename')
     parser.add_argument('--master_terms_filename')
     parser.add_argument('--target_filepath')
+    parser.add_argument('--master_index_dir')  # optional, keeps the fitted master between runs
+    parser.add_argument('--float32', action='store_true')  # halves scoring memory, scores may differ in the last digit
+    parser.add_argument('--candidates', action='store_true')  # score only pairs proposed by the n-gram inverted index
+    parser.add_argument('--recall_report')  # with --candidates, json file comparing them with brute force
+    parser.add_argument('--workers', type=int, default=1)  # processes scoring the brute-force path
+    parser.add_argument('--exact_prepass', action='store_true')  # resolve normalized exact duplicates without scoring
+    parser.add_argument('--native_ngrams', action='store_true')  # vectorize with numpy instead of a Python analyzer
+    parser.add_argument('--hash_features', type=int)  # hash bigrams into this many columns, implies --native_ngrams
+    parser.add_argument('--small_input_limit', type=int, default=SMALL_INPUT_LIMIT)  # fewer terms skip scikit-learn, 0 never
+    parser.add_argument('--metrics_out')  # jsonl file of per-stage time, memory, matrix sizes and term counts
+    parser.add_argument('--cache_dir')  # reuse similarities of unchanged terms from earlier runs
     
     args = parser.parse_args()
+    metrics = Metrics('only_find_duplicates')
+    cache = open_cache(args.cache_dir)
 
     # internal duplicates
-    new_terms_lower, new_terms_cased = load_master_terms(args.new_terms_filename)
-    tf_idf_matrix = get_internal_tf_idf_matrix(new_terms_lower)
-    cos_sim_table = get_internal_similarities(tf_idf_matrix)
-    internal_duplicates = find_internal_duplicates(
-        new_terms_cased,
-        cos_sim_table,
-        cutoff_sim=2  # keep all duplicates even 100%
-        )
+    with metrics.stage('vectorize_terms') as record:
+        new_terms_lower, new_terms_cased = load_master_terms(args.new_terms_filename)
+        native = uses_native_ngrams(args.native_ngrams, len(new_terms_lower), args.small_input_limit)
+        tf_idf_matrix = get_internal_tf_idf_matrix(new_terms_lower, native, args.hash_features)
+        record.update(matrix_info(tf_idf_matrix))
+
+    with metrics.stage('internal_similarities') as record:
+        neighbours, exact_groups = score_internal_neighbours(tf_idf_matrix, new_terms_lower, args, record, cache)
+        best_internal_matches = get_best_internal_matches(neighbours)
+        internal_duplicates = find_internal_duplicates(
+            best_internal_matches,
+            cutoff_sim=2,  # keep all duplicates even 100%
+            exact=get_internal_exact_matches(best_internal_matches, exact_groups)
+            )
     
     # external duplicates
-    old_terms_lower, old_terms_cased = load_master_terms(args.master_terms_filename)
-    vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
-    old_tf_idf_matrix = vectorizer.fit_transform(old_terms_lower)
-    new_tf_idf_matrix = vectorizer.transform(new_terms_lower)
-    new_vs_old_cos_sim_table = compute_cosine_similarity_in_chunks(
-        new_tf_idf_matrix, 
-        old_tf_idf_matrix
-        )
-    
-    vs_master = find_duplicates_vs_master(
-            results=internal_duplicates,
-            cos_sim_table=new_vs_old_cos_sim_table,
-            old_terms_cased=old_terms_cased,
-            cutoff_sim=2  # keep all duplicates even 100%
+    with metrics.stage('load_master') as record:
+        vectorizer, old_tf_idf_matrix, old_terms_cased = load_or_build_master_index(
+            args.master_terms_filename,
+            args.master_index_dir,
+            # a stored index keeps its format, it is loaded without scikit-learn anyway
+            native=native if args.master_index_dir is None else args.native_ngrams,
+            n_features=args.hash_features
             )
+        record.update(matrix_info(old_tf_idf_matrix))
+
+    with metrics.stage('master_similarities') as record:
+        new_tf_idf_matrix = vectorizer.transform(new_terms_lower)
+        best_master_matches, master_exact = score_vs_master(
+            new_tf_idf_matrix, new_terms_lower, vectorizer, old_tf_idf_matrix, old_terms_cased, args, record,
+            exact_groups, cache
+            )
+
+    if args.candidates and args.recall_report:
+        with metrics.stage('recall_report'):
+            import candidate_index
+            candidate_index.write_recall_report([
+                candidate_index.internal_recall_report(tf_idf_matrix, neighbours),
+                candidate_index.master_recall_report(new_tf_idf_matrix, old_tf_idf_matrix, best_master_matches)
+                ], args.recall_report)
     
-    write_file(args.target_filepath, vs_master)
+    with metrics.stage('report') as record:
+        vs_master = find_duplicates_vs_master(
+                records=internal_duplicates,
+                best_matches=best_master_matches,
+                cutoff_sim=2,  # keep all duplicates even 100%
+                exact=master_exact
+                )
+        
+        write_file(args.target_filepath, format_vs_master(vs_master, new_terms_cased, old_terms_cased, cutoff_sim=2))
+        record['terms'] = len(vs_master)
+        record['with_master_match'] = int(np.count_nonzero(vs_master['master_idx'] >= 0))
+        record['with_internal_duplicate'] = int(np.count_nonzero(vs_master['internal_idx'] >= 0))
+
+    if cache is not None:
+        cache.close()
+    metrics.write(args.metrics_out)
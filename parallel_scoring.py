@@ -0,0 +1,105 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pool
+import numpy as np
+import scipy.sparse as sp
+
+import find_duplicates
+
+
+# matrices loaded once per worker process by init_worker
+_matrices = {}
+
+
+def save_shared_matrix(matrix, dirname, name):
+    """Write the arrays of a csr matrix to .npy files that workers can memory-map."""
+    matrix = sp.csr_matrix(matrix)
+    for part in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(dirname, f'{name}_{part}.npy'), getattr(matrix, part))
+    return dirname, name, matrix.shape
+
+
+def load_shared_matrix(dirname, name, shape):
+    # copy-on-write mapping: pages are shared with the other workers
+    # through the page cache, and nothing is ever written back
+    data, indices, indptr = (
+        np.load(os.path.join(dirname, f'{name}_{part}.npy'), mmap_mode='c')
+        for part in ('data', 'indices', 'indptr')
+        )
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def init_worker(shared):
+    for key, (dirname, name, shape) in shared.items():
+        _matrices[key] = load_shared_matrix(dirname, name, shape)
+
+
+@contextmanager
+def shared_pool(workers, matrices):
+    """Yield a process pool whose workers memory-map the given matrices
+    instead of receiving a pickled copy of each."""
+    with tempfile.TemporaryDirectory() as dirname:
+        shared = {key: save_shared_matrix(matrix, dirname, key) for key, matrix in matrices.items()}
+        with Pool(workers, initializer=init_worker, initargs=(shared,)) as pool:
+            yield pool
+
+
+def score_internal_block(task):
+    start_idx, end_idx, threshold, top_k = task
+    return find_duplicates.get_internal_similarity_block(_matrices['terms'], start_idx, end_idx, threshold, top_k)
+
+
+def score_master_chunk(task):
+    start_idx, end_idx, top_k, dtype, block_size = task
+    best_ids, best_scores = find_duplicates.compute_best_matches_in_chunks(
+        _matrices['terms'],
+        _matrices['master'][start_idx:end_idx],
+        chunk_size=end_idx - start_idx,
+        top_k=top_k,
+        dtype=dtype,
+        block_size=block_size,
+        normalized=True
+        )
+    return np.where(best_ids >= 0, best_ids + start_idx, -1), best_scores
+
+
+def get_internal_similarity_blocks_parallel(unit_matrix, threshold=0.8, top_k=None, block_size=500, workers=2):
+    """Return the blocks of get_internal_similarity_block, in order, computed by a pool."""
+    n_terms = unit_matrix.shape[0]
+    tasks = [
+        (start_idx, min(start_idx + block_size, n_terms), threshold, top_k)
+        for start_idx in range(0, n_terms, block_size)
+        ]
+    with shared_pool(workers, {'terms': unit_matrix}) as pool:
+        return pool.map(score_internal_block, tasks)
+
+
+def compute_best_matches_parallel(tf_idf_matrix, old_tf_idf_matrix, chunk_size=10_000, top_k=1,
+                                  dtype=np.float64, block_size=1_000, workers=2, normalized=False):
+    """Same result as compute_best_matches_in_chunks, with master chunks scored by a pool.
+
+    Chunk results are merged in master order, so the output does not depend
+    on which worker finishes first.
+    """
+    tf_idf_matrix = sp.csr_matrix(tf_idf_matrix, dtype=dtype)
+    old_tf_idf_matrix = sp.csr_matrix(old_tf_idf_matrix, dtype=dtype)
+    if not normalized:
+        # the workers get unit rows, so no chunk is normalized twice
+        tf_idf_matrix = find_duplicates.normalize_rows(tf_idf_matrix)
+        old_tf_idf_matrix = find_duplicates.normalize_rows(old_tf_idf_matrix)
+    n_terms, n_old_terms = tf_idf_matrix.shape[0], old_tf_idf_matrix.shape[0]
+    best_ids = np.full((n_terms, top_k), -1, dtype=np.int64)
+    best_scores = np.zeros((n_terms, top_k), dtype=dtype)
+    tasks = [
+        (start_idx, min(start_idx + chunk_size, n_old_terms), top_k, dtype, block_size)
+        for start_idx in range(0, n_old_terms, chunk_size)
+        ]
+
+    matrices = {'terms': tf_idf_matrix, 'master': old_tf_idf_matrix}
+    with shared_pool(workers, matrices) as pool:
+        for chunk_ids, chunk_scores in pool.imap(score_master_chunk, tasks):
+            best_ids, best_scores = find_duplicates.merge_best_matches(
+                best_ids, best_scores, chunk_ids, chunk_scores, top_k
+                )
+    return best_ids, best_scores
@@ -0,0 +1,77 @@
+import argparse
+
+from metrics import Metrics
+from metrics import counted
+from preprocess import iter_prompts
+from preprocess import save_prompts
+from postprocess import read_responses
+from postprocess import get_unique_segments_terms_context
+from postprocess import write_unique_terms_contexts
+from find_duplicates import add_find_duplicates_arguments
+from find_duplicates import find_and_report_duplicates
+
+
+def get_prompts(source_filepath, prompt_start, max_words, workers=1, cache=None, requests_filepath=None):
+    """Return the prompts preprocess.py would write, saving them only with requests_filepath."""
+    prompts = list(iter_prompts(source_filepath, prompt_start, max_words, workers, cache))
+    if requests_filepath:
+        save_prompts(prompts, requests_filepath)
+    return prompts
+
+
+def get_terms_contexts(prompts, responses, workers=1, max_contexts=None, cache=None, terms_contexts_filename=None):
+    """Return the terms postprocess.py would write for the prompts and their LLM responses.
+
+    The requests are taken from the prompts in memory instead of a requests file;
+    the terms are written only with terms_contexts_filename.
+    """
+    segments = (
+        (prompt['text'], response, prompt['source'])
+        for prompt, response in zip(prompts, responses)
+        )
+    terms_contexts_uniq = get_unique_segments_terms_context(segments, workers, max_contexts, cache)
+    if terms_contexts_filename:
+        write_unique_terms_contexts(terms_contexts_uniq, terms_contexts_filename)
+    return terms_contexts_uniq
+
+
+if __name__ == '__main__':
+    # preprocess -> LLM -> postprocess -> find_duplicates in one process; without
+    # --responses_filename only the requests for the LLM are written
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source_filepath')
+    parser.add_argument('--prompt_start')
+    parser.add_argument('--max_words')
+    parser.add_argument('--requests_filepath')  # optional, written for the LLM
+    parser.add_argument('--responses_filename')  # LLM responses to the requests, in the same order
+    parser.add_argument('--max_contexts', type=int)  # keep only the first contexts of each term
+    parser.add_argument('--terms_contexts_filename')  # optional, written as by postprocess.py
+    add_find_duplicates_arguments(parser)
+    parser.add_argument('--metrics_out')  # jsonl file of per-stage time, memory and counts
+    parser.add_argument('--cache_dir')  # reuse the results of unchanged inputs of every stage
+    args = parser.parse_args()
+    metrics = Metrics('pipeline')
+    cache = None
+    if args.cache_dir:
+        from stage_cache import open_cache
+        cache = open_cache(args.cache_dir)
+
+    with metrics.stage('prompts') as record:
+        prompts = get_prompts(
+            args.source_filepath, args.prompt_start, args.max_words, args.workers, cache, args.requests_filepath
+            )
+        record['prompts'] = len(prompts)
+
+    if args.responses_filename:
+        with metrics.stage('terms_contexts') as record:
+            responses = counted(read_responses(args.responses_filename), record, 'responses')
+            terms_contexts_uniq = get_terms_contexts(
+                prompts, responses, args.workers, args.max_contexts, cache, args.terms_contexts_filename
+                )
+            record['terms'] = len(terms_contexts_uniq)
+
+        find_and_report_duplicates(terms_contexts_uniq, args, metrics, cache)
+
+    if cache is not None:
+        cache.close()
+    metrics.write(args.metrics_out)
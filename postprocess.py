@@ -1,6 +1,14 @@
 import argparse
 import json
-import re
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+
+from metrics import Metrics
+from metrics import counted
+from preprocess import is_jsonl
+from preprocess import iter_jsonl
+from preprocess import write_jsonl
 
 
 def strip_punctuation(text):
@@ -16,77 +24,206 @@ def strip_punctuation(text):
     return text.strip(punctuation)
 
 
-def find_substring_contexts(substring, larger_string):
+def collect_contexts(collected, contexts, max_contexts=None):
+    """Add contexts to the dict collected until it holds max_contexts of them.
+
+    A dict dedups by hash and keeps the first-seen order. contexts can be
+    a generator, which is not consumed further once the dict is full.
     """
-    # Example usage
-    substring = 'health and safety standards'
-    larger_string = 'Ensuring compliance with Health and Safety Standards is paramount for any organization. \
-    By rigorously adhering to these health and safety standards, companies can prevent workplace injuries and \
-    create a secure environment for their employees. Regular training and updates on health and safety standards \
-    help maintain a culture of awareness and responsibility, fostering a proactive approach to potential hazards \
-    and promoting overall well-being.'
-
-    find_substring_contexts(substring, larger_string)
-    ['Ensuring compliance with Health and Safety Standards is paramount for any organization. By r',
-      'zation. By rigorously adhering to these health and safety standards, companies can prevent workplace injuri',
-      'loyees. Regular training and updates on health and safety standards help maintain a culture of awareness an'
-      ]
+    for context in contexts:
+        if max_contexts is not None and len(collected) >= max_contexts:
+            break
+        collected[context] = None
+    return collected
+
+
+def to_lower(text):
+    """Lowercase text without changing its length, so offsets stay valid."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+def build_matcher(patterns):
+    """Return an Aho-Corasick automaton (goto, fail, output) for the patterns.
+
+    output[state] lists the indices of the patterns ending in that state.
     """
+    goto = [{}]
+    output = [()]
+    for pattern_idx, pattern in enumerate(patterns):
+        state = 0
+        for char in pattern:
+            transitions = goto[state]
+            next_state = transitions.get(char)
+            if next_state is None:
+                next_state = transitions[char] = len(goto)
+                goto.append({})
+                output.append(())
+            state = next_state
+        output[state] += (pattern_idx,)
+
+    fail = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fail_state = fail[state]
+            while fail_state and char not in goto[fail_state]:
+                fail_state = fail[fail_state]
+            fail_state = goto[fail_state].get(char, 0)
+            fail[next_state] = fail_state
+            if output[fail_state]:
+                output[next_state] += output[fail_state]
+    return goto, fail, output
 
-    # Create a case insensitive pattern with the substring
-    pattern = re.compile(re.escape(substring), re.IGNORECASE)
 
-    matches = []
-    for match in pattern.finditer(larger_string):
-        start = max(match.start() - 40, 0)
-        end = min(match.end() + 40, len(larger_string))
-        context = larger_string[start:end]
-        if context not in matches:
-            matches.append(context)
+def find_all_matches(patterns, text):
+    """Return (start, end) spans of every pattern in text, in a single scan.
+
+    Like re.finditer, the spans of each pattern do not overlap.
+    """
+    goto, fail, output = build_matcher(patterns)
+    spans = [[] for _ in patterns]
+    state = 0
+    for end, char in enumerate(text, 1):
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+        if output[state]:
+            for pattern_idx in output[state]:
+                start = end - len(patterns[pattern_idx])
+                pattern_spans = spans[pattern_idx]
+                if not pattern_spans or start >= pattern_spans[-1][1]:
+                    pattern_spans.append((start, end))
+    return spans
 
-    return matches
+
+def get_segment_terms_contexts(request, response, filename, max_contexts=None):
+    """Return [(term, contexts, filename)] for the terms of one LLM response.
+
+    All terms are matched case-insensitively in one scan of the segment,
+    which gives at once the presence check, the casing used in the text
+    (the first all-lowercase match, else the last one) and the contexts,
+    40 characters around each match, at most max_contexts of them.
+    """
+    terms = response.split('\n')
+    terms = [strip_punctuation(text) for text in terms]
+    terms = [t for t in terms if t]
+    terms = list(dict.fromkeys(terms))
+    all_spans = find_all_matches([to_lower(t) for t in terms], to_lower(request))
+
+    terms_contexts_filenames = []
+    for spans in all_spans:
+        if not spans:
+            continue
+        matches = [request[start:end] for start, end in spans]
+        cased_term = next((match for match in matches if match.islower()), matches[-1])
+        contexts = (request[max(start - 40, 0):min(end + 40, len(request))] for start, end in spans)
+        contexts = list(collect_contexts({}, contexts, max_contexts))
+        terms_contexts_filenames.append((cased_term, contexts, filename))
+    return terms_contexts_filenames
 
 
 def read_responses(responses_filename):
+    """Return the LLM responses: a JSON list, or a generator over
+    a .jsonl file holding one response string per line."""
+    if is_jsonl(responses_filename):
+        return iter_jsonl(responses_filename)
     with open(responses_filename, 'r', encoding='utf-8') as from_f:
         text_responses = json.load(from_f)
 
     return text_responses
 
 
-def read_requests(requests_filename):
-    texts = []
-    source_names = []
-    with open(requests_filename, 'r', encoding='utf-8') as f:
-        for line in f:
-            prompt_dict = json.loads(line)
-            texts.append(prompt_dict['text'])
-            source_names.append(prompt_dict['source'])
-    return texts, source_names
+def iter_requests(requests_filename):
+    """Yield (text, source) of each prompt in the requests file."""
+    for prompt_dict in iter_jsonl(requests_filename):
+        yield prompt_dict['text'], prompt_dict['source']
 
 
-def get_unique_terms_context(requests, responses, filenames):
+def get_unique_terms_context(requests, responses, filenames, max_contexts=None):
     """Return terms extracted by LLM plus their contexts
     from the corresponding text segments, plus filenames
     {'t1': {'contexts': [], 'filename': 'f1}}
+
+    Contexts are unique and in the order they were found;
+    with max_contexts only the first max_contexts are kept.
     """
-    terms_contexts_filenames_lst = []
-
-    for i in range(len(responses)):
-        terms = responses[i].split('\n')
-        terms = [strip_punctuation(text) for text in terms]
-        terms = [t for t in terms if t]
-        terms = list(dict.fromkeys(terms))
-        present_terms =[t for t in terms if t.lower() in requests[i].lower()]
-        cased_terms = [change_case(t, requests[i]) for t in present_terms]
-        terms_contexts_filenames = [(t, find_substring_contexts(t, requests[i]), filenames[i]) for t in cased_terms]
-        # [[('t1', [matches], 'f1'), ('t2', [matches], 'f1'), ..., [...]]
-        terms_contexts_filenames_lst.append(terms_contexts_filenames)
+    return get_unique_segments_terms_context(zip(requests, responses, filenames), max_contexts=max_contexts)
+
+
+def get_segment_terms_contexts_task(segment, max_contexts=None):
+    return get_segment_terms_contexts(*segment, max_contexts=max_contexts)
+
+
+def get_cached_segment_terms_contexts_task(task, max_contexts=None):
+    """Return (key, terms contexts, computed), matching the segment only when nothing was cached."""
+    key, segment, cached = task
+    if cached is not None:
+        return key, cached, False
+    return key, get_segment_terms_contexts_task(segment, max_contexts), True
 
+
+def iter_cached_segments_terms_contexts(segments, workers, max_contexts, cache):
+    """Same as iter_segments_terms_contexts, matching only the segments not cached yet.
+
+    A segment's terms depend only on its request, response and filename,
+    so they are cached under those and max_contexts; cached terms come back
+    from JSON as lists rather than tuples.
+    """
+    from stage_cache import make_key
+
+    def get_cache_tasks():
+        for segment in segments:
+            key = make_key('segment-terms-v1', list(segment), max_contexts)
+            yield key, segment, cache.get_json(key)
+
+    task = partial(get_cached_segment_terms_contexts_task, max_contexts=max_contexts)
+    if workers > 1:
+        with Pool(workers) as pool:
+            for key, terms_contexts_filenames, computed in pool.imap(task, get_cache_tasks(), chunksize=64):
+                if computed:
+                    cache.put_json(key, terms_contexts_filenames)
+                yield terms_contexts_filenames
+    else:
+        for key, terms_contexts_filenames, computed in map(task, get_cache_tasks()):
+            if computed:
+                cache.put_json(key, terms_contexts_filenames)
+            yield terms_contexts_filenames
+
+
+def iter_segments_terms_contexts(segments, workers=1, max_contexts=None, cache=None):
+    """Yield the result of get_segment_terms_contexts for each segment, in order.
+
+    With workers > 1 segments are processed by a process pool; imap returns
+    the results in segment order, so merging them gives the same terms.
+    With a StageCache only new or changed segments are matched.
+    """
+    if cache is not None:
+        yield from iter_cached_segments_terms_contexts(segments, workers, max_contexts, cache)
+    elif workers > 1:
+        with Pool(workers) as pool:
+            task = partial(get_segment_terms_contexts_task, max_contexts=max_contexts)
+            yield from pool.imap(task, segments, chunksize=64)
+    else:
+        for segment in segments:
+            yield get_segment_terms_contexts_task(segment, max_contexts)
+
+
+def get_unique_segments_terms_context(segments, workers=1, max_contexts=None, cache=None):
+    """Same as get_unique_terms_context for (request, response, filename) tuples.
+
+    segments can be a generator: they are processed one at a time
+    and only the unique terms are kept in memory.
+    """
     # Keep only unique terms
     terms_contexts_filenames_uniq = {}
-    for sub_list in terms_contexts_filenames_lst:
-        for term_context_filename in sub_list:  # terms and their contents
+    for terms_contexts_filenames in iter_segments_terms_contexts(segments, workers, max_contexts, cache):
+        # [('t1', [matches], 'f1'), ('t2', [matches], 'f1'), ...]
+        for term_context_filename in terms_contexts_filenames:  # terms and their contents
             term = term_context_filename[0]
             contexts = term_context_filename[1]
             filename = term_context_filename[2]
@@ -94,44 +231,68 @@ def get_unique_terms_context(requests, responses, filenames):
                 if terms_contexts_filenames_uniq[term]['filename'] == filename:
                     # only keep the term's contexts for the first source file
                     # where the term is found
-                    terms_contexts_filenames_uniq[term]['contexts'].extend(contexts)
+                    collect_contexts(terms_contexts_filenames_uniq[term]['contexts'], contexts, max_contexts)
             else:
-                terms_contexts_filenames_uniq[term] = {'contexts': contexts, 'filename': filename}
+                terms_contexts_filenames_uniq[term] = {
+                    'contexts': collect_contexts({}, contexts, max_contexts),
+                    'filename': filename
+                    }
 
-    # make contexts unique
+    # contexts were collected as dict keys: unique, in the order they were found
     for term in terms_contexts_filenames_uniq.keys():
-        unique_contexts = list(set(terms_contexts_filenames_uniq[term]['contexts']))
+        unique_contexts = list(terms_contexts_filenames_uniq[term]['contexts'])
         terms_contexts_filenames_uniq[term]['contexts'] = unique_contexts
 
     return terms_contexts_filenames_uniq
 
 
 def write_unique_terms_contexts(terms_contexts_uniq, filename):
+    """Write the terms as one JSON dict, or one line per term to a .jsonl file."""
+    if is_jsonl(filename):
+        write_jsonl((
+            {'term': term, 'contexts': value['contexts'], 'filename': value['filename']}
+            for term, value in terms_contexts_uniq.items()
+            ), filename)
+        return
     with open(filename, 'w', encoding='utf-8') as to_f:
         json.dump(terms_contexts_uniq, to_f)
 
 
-def change_case(term, context):
-    pattern = re.compile(re.escape(term), re.IGNORECASE)
-    matches = []
-    for m in pattern.finditer(context):
-        matches.append(context[m.start():m.end()])
-    for match in matches:
-        if match.islower():
-            return match
-    return matches[-1]
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--responses_filename')
     parser.add_argument('--requests_filename')
     parser.add_argument('--terms_contexts_filename')
+    parser.add_argument('--workers', type=int, default=1)  # processes matching terms in segments
+    parser.add_argument('--max_contexts', type=int)  # keep only the first contexts of each term
+    parser.add_argument('--metrics_out')  # jsonl file of per-stage time, memory and term counts
+    parser.add_argument('--cache_dir')  # reuse the terms of segments unchanged since an earlier run
     args = parser.parse_args()
 
 
-    responses = read_responses(args.responses_filename)
-    requests, source_names = read_requests(args.requests_filename)
-    terms_contexts_uniq = get_unique_terms_context(requests, responses, source_names) 
-    write_unique_terms_contexts(terms_contexts_uniq, args.terms_contexts_filename)
+    metrics = Metrics('postprocess')
+    cache = None
+    if args.cache_dir:
+        from stage_cache import open_cache
+        cache = open_cache(args.cache_dir)
+
+    with metrics.stage('terms_contexts') as record:
+        responses = read_responses(args.responses_filename)
+        segments = (
+            (request, response, source_name)
+            for (request, source_name), response in zip(iter_requests(args.requests_filename), responses)
+            )
+        segments = counted(segments, record, 'segments')
+        terms_contexts_uniq = get_unique_segments_terms_context(segments, args.workers, args.max_contexts, cache)
+        record['terms'] = len(terms_contexts_uniq)
+        record['contexts'] = sum(len(value['contexts']) for value in terms_contexts_uniq.values())
+        if cache is not None:
+            record['cached_segments'] = cache.hits
+
+    with metrics.stage('write'):
+        write_unique_terms_contexts(terms_contexts_uniq, args.terms_contexts_filename)
+
+    if cache is not None:
+        cache.close()
+    metrics.write(args.metrics_out)
     
\ No newline at end of file
@@ -1,64 +1,159 @@
 import argparse
 import json
 import os
+from multiprocessing import Pool
+
+from metrics import Metrics
+from metrics import counted
 
 
 def split_texts(texts, max_words=250):
+    return list(iter_split_texts(texts, max_words))
+
+
+def iter_split_texts(texts, max_words=250):
+    """Yield the subtexts of split_texts one at a time; texts can be a generator."""
     max_words = int(max_words)
-    subtexts = []
-    current_subtext = ''
+    # lines are joined once per subtext rather than concatenated one by one
+    current_lines = []
     current_words = 0
 
     for text in texts:
         text_length_words = len(text.split())
 
-        # Add the text to the current subtext and update the character count
-        if current_subtext:
-            current_subtext += '\n' + text
-        else:
-            current_subtext = text
+        # Add the text to the current subtext and update the word count;
+        # leading empty texts are skipped, as they would add nothing
+        if text or current_lines:
+            current_lines.append(text)
         current_words += text_length_words
 
         # Check if the limit is exceeded after adding the new text
         if current_words > max_words:
-            subtexts.append(current_subtext.strip())
-            current_subtext = ''
+            yield '\n'.join(current_lines).strip()
+            current_lines = []
             current_words = 0
 
     # Append the last subtext if not empty
-    if current_subtext:
-        subtexts.append(current_subtext.strip())
+    if current_lines:
+        yield '\n'.join(current_lines).strip()
 
-    return subtexts
 
+def is_jsonl(filename):
+    return filename.lower().endswith('.jsonl')
 
-def save_prompts(prompts_lst, requests_filename):
-    with open(requests_filename, 'w', encoding='utf-8') as f:
-        for prompt in prompts_lst:
-            json_string = json.dumps(prompt, ensure_ascii=False)
+
+def iter_jsonl(filename):
+    """Yield the records of a line-delimited JSON file one at a time."""
+    with open(filename, 'r', encoding='utf-8') as from_f:
+        for line in from_f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_jsonl(records, filename):
+    """Write records, which can be a generator, one JSON object per line."""
+    with open(filename, 'w', encoding='utf-8') as f:
+        for record in records:
+            json_string = json.dumps(record, ensure_ascii=False)
             f.write(json_string + '\n')
 
 
-def get_lines(source_filepath):
-    source_list = []
-    # count = 0
+def save_prompts(prompts_lst, requests_filename):
+    write_jsonl(prompts_lst, requests_filename)
+
+
+def iter_lines(source_filepath):
     with open(source_filepath, 'r', encoding='utf-8') as in_f:
         for line in in_f:
             line = line.strip()
             if line:
-                # count += len(line)
-                source_list.append(line)
-    return source_list
-
-
-def build_prompts(prompt_start, source_split, filename):
-    prompts = [
-        {   
-            'prompt': prompt_start, 
-            'text': text, 
-            'source': filename
-            } for text in source_split]
-    return prompts
+                yield line
+
+
+def iter_source_files(source_filepath):
+    """Yield (path, source name) of every file below source_filepath in sorted order.
+
+    The source name is the path relative to source_filepath, with '/' separators,
+    so files directly in source_filepath keep their plain file name.
+    """
+    for dirpath, dirnames, filenames in os.walk(source_filepath):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield path, os.path.relpath(path, source_filepath).replace(os.sep, '/')
+
+
+def iter_file_prompts(path, source, prompt_start, max_words):
+    all_lines = iter_lines(path)
+    for text in iter_split_texts(all_lines, max_words):
+        yield {
+            'prompt': prompt_start,
+            'text': text,
+            'source': source
+            }
+
+
+def get_file_prompts(task):
+    return list(iter_file_prompts(*task))
+
+
+def get_cached_file_prompts(task):
+    """Return (key, prompts, computed), splitting the file only when nothing was cached."""
+    key, file_task, cached = task
+    if cached is not None:
+        return key, cached, False
+    return key, get_file_prompts(file_task), True
+
+
+def iter_cached_prompts(tasks, workers, cache):
+    """Same as the prompts of tasks, splitting only the files not cached yet.
+
+    The prompts of a file are cached under the hash of its content, its
+    source name and the split settings, so edited files are split again.
+    """
+    from stage_cache import hash_bytes, make_key
+
+    def get_cache_tasks():
+        for task in tasks:
+            path, source, prompt_start, max_words = task
+            with open(path, 'rb') as from_f:
+                file_hash = hash_bytes(from_f.read())
+            key = make_key('file-prompts-v1', file_hash, source, prompt_start, int(max_words))
+            yield key, task, cache.get_json(key)
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            for key, prompts, computed in pool.imap(get_cached_file_prompts, get_cache_tasks(), chunksize=8):
+                if computed:
+                    cache.put_json(key, prompts)
+                yield from prompts
+    else:
+        for key, prompts, computed in map(get_cached_file_prompts, get_cache_tasks()):
+            if computed:
+                cache.put_json(key, prompts)
+            yield from prompts
+
+
+def iter_prompts(source_filepath, prompt_start, max_words, workers=1, cache=None):
+    """Yield the prompts of all source files, file by file in sorted order.
+
+    With workers > 1 files are split in a process pool; results are still
+    yielded in file order, so the output does not depend on the workers.
+    With a StageCache only new or changed files are split.
+    """
+    tasks = (
+        (path, source, prompt_start, max_words)
+        for path, source in iter_source_files(source_filepath)
+        )
+    if cache is not None:
+        yield from iter_cached_prompts(tasks, workers, cache)
+    elif workers > 1:
+        with Pool(workers) as pool:
+            for prompts in pool.imap(get_file_prompts, tasks, chunksize=8):
+                yield from prompts
+    else:
+        for task in tasks:
+            yield from iter_file_prompts(*task)
 
 
 if __name__ == '__main__':
@@ -67,15 +162,22 @@ if __name__ == '__main__':
     parser.add_argument('--prompt_start')
     parser.add_argument('--max_words')
     parser.add_argument('--requests_filepath')
+    parser.add_argument('--workers', type=int, default=1)  # processes splitting source files
+    parser.add_argument('--metrics_out')  # jsonl file of time, memory and prompt counts
+    parser.add_argument('--cache_dir')  # reuse the prompts of source files unchanged since an earlier run
     args = parser.parse_args()
-
-    files_lst = os.listdir(args.source_filepath)
-    prompts_lst = []
-    for f in files_lst:
-        all_lines = get_lines(os.path.join(args.source_filepath, f))
-        source_split = split_texts(all_lines, args.max_words)
-        filename = os.path.basename(f)
-        prompts = build_prompts(args.prompt_start, source_split, f)
-        prompts_lst.extend(prompts)
-    
-    save_prompts(prompts_lst, args.requests_filepath)
+    metrics = Metrics('preprocess')
+    cache = None
+    if args.cache_dir:
+        from stage_cache import open_cache
+        cache = open_cache(args.cache_dir)
+
+    with metrics.stage('prompts') as record:
+        prompts = iter_prompts(args.source_filepath, args.prompt_start, args.max_words, args.workers, cache)
+        save_prompts(counted(prompts, record, 'prompts'), args.requests_filepath)
+        if cache is not None:
+            record['cached_files'] = cache.hits
+
+    if cache is not None:
+        cache.close()
+    metrics.write(args.metrics_out)
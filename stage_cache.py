@@ -0,0 +1,126 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import scipy.sparse as sp
+
+
+CACHE_FILENAME = 'stage_cache.sqlite'
+# commit after this many new entries, so an interrupted run keeps most of its work
+COMMIT_EVERY = 1_000
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(*parts):
+    """Return the content address of a stage input: the sha256 of its JSON-encoded parts.
+
+    The first part names the stage and its version, so changing how a stage
+    computes its output only needs a new version to invalidate old entries.
+    """
+    return hash_bytes(json.dumps(parts, ensure_ascii=False).encode('utf-8'))
+
+
+def matrix_to_bytes(matrix):
+    matrix = sp.csr_matrix(matrix)
+    buffer = io.BytesIO()
+    np.savez(buffer, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape)
+    return buffer.getvalue()
+
+
+def matrix_from_bytes(value):
+    arrays = np.load(io.BytesIO(value))
+    return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']))
+
+
+class StageCache:
+    """Key-value store of stage outputs in an SQLite file under cache_dir.
+
+    It can be shared by the feeder thread of a process pool and the main
+    thread, but not by several processes at once.
+    """
+
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(cache_dir, CACHE_FILENAME), check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)')
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', (key, value))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def get_json(self, key):
+        value = self.get(key)
+        return None if value is None else json.loads(value)
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value, ensure_ascii=False))
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def open_cache(cache_dir):
+    """Return a StageCache, or None when no cache_dir is given."""
+    return StageCache(cache_dir) if cache_dir else None
+
+
+def get_cached_master_matches(cache, master_key, terms_lower, tf_idf_matrix, old_tf_idf_matrix,
+                              candidates=False, dtype=np.float64, workers=1):
+    """Same result as score_master_matches, scoring only the terms not cached yet.
+
+    The best match of a term depends only on the term and the master index,
+    so it is cached per term under master_key and the scoring options.
+    """
+    from find_duplicates import score_master_matches
+
+    keys = [
+        make_key('master-match-v1', master_key, candidates, np.dtype(dtype).name, term)
+        for term in terms_lower
+        ]
+    cached = [cache.get_json(key) for key in keys]
+    missing = np.array([pos for pos, value in enumerate(cached) if value is None], dtype=np.int64)
+
+    best_ids = np.array([value[0] if value is not None else -1 for value in cached], dtype=np.int64)
+    best_scores = np.array([value[1] if value is not None else 0 for value in cached], dtype=dtype)
+    if len(missing):
+        scored_ids, scored_scores = score_master_matches(
+            tf_idf_matrix[missing], old_tf_idf_matrix, candidates, dtype, workers
+            )
+        best_ids[missing], best_scores[missing] = scored_ids, scored_scores
+        for pos, best_id, best_score in zip(missing.tolist(), scored_ids.tolist(), scored_scores.tolist()):
+            cache.put_json(keys[pos], [best_id, best_score])
+    return best_ids, best_scores
+
+
+def get_master_key(master_terms_filename, vectorizer):
+    """Identify the master index: the master file plus the idf it was weighted with,
+    which differs when an index only had terms appended."""
+    with open(master_terms_filename, 'rb') as from_f:
+        master_hash = hash_bytes(from_f.read())
+    idf_hash = hash_bytes(np.ascontiguousarray(vectorizer.idf_).tobytes())
+    return make_key('master-v1', master_hash, idf_hash, type(vectorizer).__name__, getattr(vectorizer, 'n_features', None))
@@ -0,0 +1,77 @@
+import os
+from array import array
+import numpy as np
+
+
+class TermStore:
+    """Read-only sequence of strings kept in one UTF-8 buffer plus an offsets array.
+
+    Item i is buffer[offsets[i]:offsets[i + 1]], decoded on access. Opened with
+    open_term_store, both arrays are memory-mapped, so processes reading the
+    same store share one copy in the page cache.
+    """
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('term store index out of range')
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def get_store_paths(store_dir, name):
+    return os.path.join(store_dir, f'{name}.bin'), os.path.join(store_dir, f'{name}_offsets.npy')
+
+
+def write_term_store(strings, store_dir, name):
+    """Write strings, which can be a generator, as the store name in store_dir.
+
+    A store is not meant to be overwritten: its two files cannot be swapped
+    together, and Windows refuses to replace a file that is memory-mapped.
+    Write each version under a new name and point readers to it, as
+    master_index does with its meta.
+    """
+    buffer_path, offsets_path = get_store_paths(store_dir, name)
+    offsets = array('q', [0])
+    with open(buffer_path, 'wb') as to_f:
+        for string in strings:
+            data = string.encode('utf-8')
+            to_f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    with open(offsets_path, 'wb') as to_f:
+        np.save(to_f, np.frombuffer(offsets, dtype=np.int64))
+
+
+def term_store_exists(store_dir, name):
+    return all(os.path.exists(path) for path in get_store_paths(store_dir, name))
+
+
+def remove_term_store(store_dir, name):
+    """Delete the files of a store; a file still mapped on Windows is left for a later call."""
+    for path in get_store_paths(store_dir, name):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def open_term_store(store_dir, name):
+    """Return the TermStore written by write_term_store, memory-mapped read-only."""
+    buffer_path, offsets_path = get_store_paths(store_dir, name)
+    offsets = np.load(offsets_path, mmap_mode='r')
+    if offsets[-1] == 0:
+        buffer = np.zeros(0, dtype=np.uint8)  # an empty file cannot be mapped
+    else:
+        buffer = np.memmap(buffer_path, dtype=np.uint8, mode='r')
+    return TermStore(buffer, offsets)
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from bigram_vectorizer import BigramVectorizer
+from find_duplicates import ngrams
+from master_index import load_or_build_master_index
+
+
+# empty, one-character, quoted, emoji, non-ASCII and repeated-bigram terms among ordinary ones
+TERMS = [
+    'quality management system', 'quality managements', '', 'a', '"quoted" term', '“curly” quotes',
+    'emoji 🙂 term', 'éléments non-ascii', 'straße', 'ababab', 'aa', '-./#!&()', 'supplysafety',
+    'safetysupply', 'multi-word, term (with) punctuation'
+    ]
+NEW_TERMS = ['quality system', 'unseen zq', '', 'x', '🙂🙂', 'Straße'.lower(), 'ababab ab']
+
+
+class BigramVectorizerTest(unittest.TestCase):
+    """BigramVectorizer must give the matrices of TfidfVectorizer(analyzer=ngrams) bit for bit."""
+
+    def assert_same_matrix(self, matrix, expected):
+        matrix, expected = matrix.tocsr(), expected.tocsr()
+        self.assertEqual(matrix.shape, expected.shape)
+        np.testing.assert_array_equal(matrix.indptr, expected.indptr)
+        np.testing.assert_array_equal(matrix.indices, expected.indices)
+        np.testing.assert_array_equal(matrix.data, expected.data)
+
+    def test_fit_transform_and_transform(self):
+        expected_vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
+        expected = expected_vectorizer.fit_transform(TERMS)
+        vectorizer = BigramVectorizer()
+        self.assert_same_matrix(vectorizer.fit_transform(TERMS), expected)
+        np.testing.assert_array_equal(vectorizer.idf_, expected_vectorizer.idf_)
+        self.assert_same_matrix(vectorizer.transform(NEW_TERMS), expected_vectorizer.transform(NEW_TERMS))
+
+    def test_from_saved_vocabulary(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            master_terms_filename = os.path.join(tmp_dir, 'master.txt')
+            with open(master_terms_filename, 'w', encoding='utf-8') as to_f:
+                to_f.write(''.join(f'{term} | translation {i}\n' for i, term in enumerate(TERMS) if term))
+            index_dir = os.path.join(tmp_dir, 'index')
+            # the first call fits a TfidfVectorizer and saves its vocabulary, the second loads it
+            expected_vectorizer, expected, _ = load_or_build_master_index(master_terms_filename, index_dir)
+            vectorizer, matrix, _ = load_or_build_master_index(master_terms_filename, index_dir)
+
+        self.assertIsInstance(expected_vectorizer, TfidfVectorizer)
+        self.assertIsInstance(vectorizer, BigramVectorizer)
+        self.assert_same_matrix(matrix, expected)
+        np.testing.assert_array_equal(vectorizer.idf_, expected_vectorizer.idf_)
+        self.assert_same_matrix(vectorizer.transform(NEW_TERMS), expected_vectorizer.transform(NEW_TERMS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from llm_runner import read_checkpoint
+from llm_runner import run_requests
+from llm_runner import write_responses
+from mock_llm_server import extract_mock_terms
+from mock_llm_server import make_mock_server
+from preprocess import write_jsonl
+
+
+N_REQUESTS = 30
+
+
+class LLMRunnerTest(unittest.TestCase):
+    """Run llm_runner against the mock server, which answers 30% of the requests with a 429."""
+
+    def setUp(self):
+        self.server = make_mock_server(fail_rate=0.3, seed=1)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.requests_filename = os.path.join(self.tmp_dir.name, 'requests.jsonl')
+        words = ['alphabet', 'betatron', 'gammaray', 'deltawing']
+        self.prompts = [
+            {'prompt': 'Extract the terms.', 'text': f'segment {i} about {words[i % 4]} number{i}', 'source': 'f.txt'}
+            for i in range(N_REQUESTS)
+            ]
+        write_jsonl(self.prompts, self.requests_filename)
+        self.settings = {
+            'url': f'http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions',
+            'api_key': None,
+            'model': 'mock',
+            'max_tokens': 100,
+            'max_retries': 20,
+            'backoff': 0.01,
+            'timeout': 10.0
+            }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def run_all(self, checkpoint_filename):
+        return asyncio.run(run_requests(self.requests_filename, checkpoint_filename, self.settings, max_in_flight=4))
+
+    def read_responses(self, responses_filename):
+        with open(responses_filename, 'r', encoding='utf-8') as from_f:
+            return json.load(from_f)
+
+    def test_retries_and_request_order(self):
+        n_requests = self.run_all(self.path('checkpoint.jsonl'))
+        write_responses(self.path('checkpoint.jsonl'), n_requests, self.path('responses.json'))
+
+        self.assertEqual(n_requests, N_REQUESTS)
+        self.assertGreater(self.server.n_requests, N_REQUESTS)  # some were answered with a 429 and retried
+        expected = [extract_mock_terms(prompt['text']) for prompt in self.prompts]
+        self.assertEqual(self.read_responses(self.path('responses.json')), expected)
+
+    def test_resume_after_crash(self):
+        n_requests = self.run_all(self.path('checkpoint.jsonl'))
+        write_responses(self.path('checkpoint.jsonl'), n_requests, self.path('responses.json'))
+
+        # a crash leaves ten complete responses and half of the eleventh
+        with open(self.path('checkpoint.jsonl'), 'rb') as from_f:
+            lines = from_f.readlines()
+        with open(self.path('crashed.jsonl'), 'wb') as to_f:
+            to_f.writelines(lines[:10])
+            to_f.write(lines[10][:len(lines[10]) // 2])
+        done_before = set(read_checkpoint(self.path('crashed.jsonl')))
+        self.assertEqual(len(done_before), 10)
+
+        self.run_all(self.path('crashed.jsonl'))
+        write_responses(self.path('crashed.jsonl'), n_requests, self.path('resumed.json'))
+
+        with open(self.path('crashed.jsonl'), 'r', encoding='utf-8') as from_f:
+            indices = [json.loads(line)['index'] for line in from_f]
+        self.assertEqual(sorted(indices), list(range(N_REQUESTS)))  # the ten saved ones were not sent again
+        self.assertEqual(self.read_responses(self.path('resumed.json')), self.read_responses(self.path('responses.json')))
+
+    def test_inserted_prompt_not_paired_with_old_responses(self):
+        n_requests = self.run_all(self.path('checkpoint.jsonl'))
+        with open(self.path('checkpoint.jsonl'), 'rb') as from_f:
+            n_lines = len(from_f.readlines())
+
+        # a new source file sorted before the others shifts every later request by one
+        self.prompts.insert(5, {'prompt': 'Extract the terms.', 'text': 'inserted segment about epsilonic', 'source': 'e.txt'})
+        write_jsonl(self.prompts, self.requests_filename)
+        n_requests = self.run_all(self.path('checkpoint.jsonl'))
+        write_responses(self.path('checkpoint.jsonl'), n_requests, self.path('responses.json'))
+
+        self.assertEqual(n_requests, N_REQUESTS + 1)
+        with open(self.path('checkpoint.jsonl'), 'r', encoding='utf-8') as from_f:
+            resent = [json.loads(line)['index'] for line in from_f][n_lines:]
+        self.assertEqual(sorted(resent), list(range(5, N_REQUESTS + 1)))  # the first five were kept
+        expected = [extract_mock_terms(prompt['text']) for prompt in self.prompts]
+        self.assertEqual(self.read_responses(self.path('responses.json')), expected)
+
+    def test_missing_responses_are_reported(self):
+        with self.assertRaises(RuntimeError):
+            write_responses(self.path('no_checkpoint.jsonl'), N_REQUESTS, self.path('responses.json'))
+
+    def test_error_not_retried(self):
+        self.settings['url'] = self.settings['url'].replace('/chat/completions', '/unknown')  # the mock answers 404
+        with self.assertRaises(RuntimeError):
+            self.run_all(self.path('checkpoint.jsonl'))
+
+
+if __name__ == '__main__':
+    unittest.main()